@@ -0,0 +1,2 @@
+# Code shared by the qtools scripts. Nothing is imported here so each tool
+# only pays for the modules it uses.
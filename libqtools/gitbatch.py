@@ -0,0 +1,277 @@
+# Long running git cat-file processes, so looking up many objects doesn't
+# cost one git (or GitPython) invocation each.
+import os
+import subprocess
+
+class CatFileCheck:
+    mode = "--batch-check"
+
+    def __init__(self, path):
+        self.path = path
+        self.proc = None
+        self.pid = None
+
+    # a forked process (multiprocessing) can't share the pipes with its
+    # parent, so it gets its own git
+    def _start(self):
+        if self.proc is not None and self.pid != os.getpid():
+            self.proc = None
+        if self.proc is None:
+            self.proc = subprocess.Popen(["git", "-C", self.path, "cat-file", self.mode],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.pid = os.getpid()
+
+    # sends name and returns the fields of the reply if the object exists
+    def _request(self, name):
+        if len(name) == 0 or len(name.split()) != 1:
+            return None
+        self._start()
+        self.proc.stdin.write(name.encode('utf-8') + b'\n')
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            raise Exception("git cat-file exited in %s" % self.path)
+        fields = line.decode('utf-8', errors='ignore').split()
+        if len(fields) != 3:
+            return None
+        return fields
+
+    # returns (sha, type) for any object name git understands or None if
+    # it's missing or ambiguous
+    def check(self, name):
+        fields = self._request(name)
+        if fields is None:
+            return None
+        return (fields[0], fields[1])
+
+    # expands a (possibly shortened) commit sha
+    def resolve_commit(self, name):
+        found = self.check("%s^{commit}" % name)
+        if found is None:
+            return None
+        return found[0]
+
+    def close(self):
+        if self.proc is not None and self.pid == os.getpid():
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+        self.proc = None
+
+class CatFile(CatFileCheck):
+    mode = "--batch"
+
+    # returns (sha, type, contents) or None if the object doesn't exist
+    def read(self, name):
+        fields = self._request(name)
+        if fields is None:
+            return None
+        size = int(fields[2])
+        data = self.proc.stdout.read(size)
+        # the contents are followed by a newline
+        if len(data) != size or self.proc.stdout.read(1) != b'\n':
+            raise Exception("git cat-file exited in %s" % self.path)
+        return (fields[0], fields[1], data)
+
+    def commit(self, name):
+        found = self.read("%s^{commit}" % name)
+        if found is None:
+            return None
+        return Commit(found[0], found[2])
+
+def _decode(value):
+    return value.decode('utf-8', errors='replace')
+
+# "Name <email> 1600000000 +0000" -> (name, email, time)
+def _parse_person(value):
+    (person, _, date) = value.rpartition(b'> ')
+    (name, _, email) = person.partition(b'<')
+    return (_decode(name.rstrip()), _decode(email), int(date.split()[0]))
+
+# A commit object. Only the raw contents are kept, the headers are parsed the
+# first time one of them is used. The contents can come with the commit
+# (iter_commits(), CatFile.commit()) or be read on first use from objects
+class Commit:
+    __slots__ = ('hexsha', '_data', '_objects', '_indented', '_header', '_body',
+                 '_tree', '_parents', '_author', '_committer', '_encoding')
+
+    def __init__(self, hexsha, data=None, objects=None, indented=False):
+        self.hexsha = hexsha
+        self._data = data
+        self._objects = objects
+        # git rev-list --header indents the message with 4 spaces
+        self._indented = indented
+        self._header = None
+
+    def __eq__(self, other):
+        return isinstance(other, Commit) and self.hexsha == other.hexsha
+
+    def __hash__(self):
+        return hash(self.hexsha)
+
+    def __str__(self):
+        return self.hexsha
+
+    def __repr__(self):
+        return "<Commit %s>" % self.hexsha
+
+    def _parse(self):
+        if self._header is not None:
+            return
+        if self._data is None:
+            found = self._objects.read(self.hexsha)
+            if found is None or found[1] != 'commit':
+                raise Exception("Unable to find commit %s in %s" % (self.hexsha, self._objects.path))
+            self._data = found[2]
+        end = self._data.find(b'\n\n')
+        if end < 0:
+            end = len(self._data)
+        self._body = self._data[end + 2:]
+        self._tree = None
+        self._parents = []
+        self._author = None
+        self._committer = None
+        self._encoding = None
+        for line in self._data[:end].split(b'\n'):
+            # continuation of a multi-line header (gpgsig, mergetag)
+            if line.startswith(b' '):
+                continue
+            (key, _, value) = line.partition(b' ')
+            if key == b'tree':
+                self._tree = value.decode()
+            elif key == b'parent':
+                self._parents.append(value.decode())
+            elif key == b'author':
+                self._author = value
+            elif key == b'committer':
+                self._committer = value
+            elif key == b'encoding':
+                self._encoding = value.decode('ascii', errors='ignore')
+        self._header = self._data[:end]
+        self._data = None
+
+    @property
+    def binsha(self):
+        return bytes.fromhex(self.hexsha)
+
+    @property
+    def tree(self):
+        self._parse()
+        return self._tree
+
+    # the parents' full shas
+    @property
+    def parents(self):
+        self._parse()
+        return self._parents
+
+    @property
+    def author_name(self):
+        self._parse()
+        return _parse_person(self._author)[0]
+
+    @property
+    def author_email(self):
+        self._parse()
+        return _parse_person(self._author)[1]
+
+    @property
+    def authored_date(self):
+        self._parse()
+        return _parse_person(self._author)[2]
+
+    @property
+    def committer_email(self):
+        self._parse()
+        return _parse_person(self._committer)[1]
+
+    @property
+    def committed_date(self):
+        self._parse()
+        return _parse_person(self._committer)[2]
+
+    # the message as stored by git
+    @property
+    def raw_message(self):
+        self._parse()
+        if not self._indented:
+            return self._body
+        return b'\n'.join([l[4:] if l.startswith(b'    ') else l for l in self._body.split(b'\n')])
+
+    @property
+    def message(self):
+        msg = self.raw_message
+        try:
+            return msg.decode(self._encoding or 'utf-8', errors='replace')
+        except LookupError:
+            return _decode(msg)
+
+    @property
+    def summary(self):
+        return self.message.split('\n', 1)[0]
+
+# yields a Commit for every commit in revs, in git rev-list order, reading
+# them all from a single git rev-list
+def iter_commits(path, revs):
+    proc = subprocess.Popen(["git", "-C", path, "rev-list", "--header", "--encoding=none"] + revs + ["--"],
+                            stdout=subprocess.PIPE)
+    buf = b''
+    try:
+        while True:
+            data = proc.stdout.read(1 << 20)
+            if not data:
+                break
+            records = (buf + data).split(b'\0')
+            buf = records.pop()
+            for r in records:
+                (sha, _, contents) = r.partition(b'\n')
+                yield Commit(sha.decode(), contents, indented=True)
+    except GeneratorExit:
+        # the caller stopped early, git may still have a lot to go
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    if rc != 0:
+        raise Exception("Unable to read history from %s (git rev-list returned %d)" % (path, rc))
+
+# Everything the tools need from a repository: commit lookups go through one
+# git cat-file --batch and --batch-check each, history walks are a single
+# git rev-list
+class Repository:
+    def __init__(self, path):
+        self.path = path
+        self.objects = CatFile(path)
+        self.resolver = CatFileCheck(path)
+
+    # returns None if name isn't a commit
+    def commit(self, name):
+        return self.objects.commit(name)
+
+    # a commit that is only read if used. sha must be a full sha
+    def lazy_commit(self, sha):
+        return Commit(sha, objects=self.objects)
+
+    def resolve_commit(self, name):
+        return self.resolver.resolve_commit(name)
+
+    def iter_commits(self, revs):
+        return iter_commits(self.path, revs)
+
+    def is_ancestor(self, ancestor, commit):
+        rc = subprocess.call(["git", "-C", self.path, "merge-base", "--is-ancestor", ancestor, commit])
+        if rc > 1:
+            raise Exception("Unable to check if %s is an ancestor of %s (git merge-base returned %d)" % (ancestor, commit, rc))
+        return rc == 0
+
+    # returns the full shas of every merge base, empty if there's none
+    def merge_bases(self, a, b):
+        proc = subprocess.run(["git", "-C", self.path, "merge-base", "--all", a, b], stdout=subprocess.PIPE)
+        if proc.returncode > 1:
+            raise Exception("Unable to find merge bases of %s and %s (git merge-base returned %d)" % (a, b, proc.returncode))
+        return proc.stdout.decode().split()
+
+    def close(self):
+        self.objects.close()
+        self.resolver.close()
@@ -0,0 +1,47 @@
+# Client side of qtoolsd. Requests and responses are single line JSON
+# objects, see qtoolsd.py for the commands.
+import os
+import sys
+import json
+import socket
+
+DEFAULT_SOCKET = '~/.qtools/qtoolsd.sock'
+# a query is never supposed to take this long, fall back to doing it locally
+QUERY_TIMEOUT = 120
+
+def get_socket_path(config):
+    if 'daemon' in config and 'socket' in config['daemon']:
+        return os.path.expanduser(config['daemon']['socket'])
+    return os.path.expanduser(DEFAULT_SOCKET)
+
+# returns the result of the request or None if the daemon isn't running or
+# failed, in which case the caller should do the work itself
+def query(config, request, path=None):
+    if os.environ.get('QTOOLS_NO_DAEMON'):
+        return None
+    if path is None:
+        path = get_socket_path(config)
+    if not os.path.exists(path):
+        return None
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(QUERY_TIMEOUT)
+    try:
+        s.connect(path)
+        f = s.makefile("rwb")
+        f.write(json.dumps(request).encode('utf-8') + b'\n')
+        f.flush()
+        line = f.readline()
+        f.close()
+    except OSError:
+        return None
+    finally:
+        s.close()
+
+    if not line:
+        return None
+    response = json.loads(line)
+    if 'error' in response:
+        sys.stderr.write("Warning: qtoolsd failed (%s), not using it\n" % response['error'])
+        return None
+    return response['result']
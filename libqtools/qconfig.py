@@ -0,0 +1,55 @@
+# Access to ~/.config/qtools/config, shared by all the tools
+import os
+import configparser
+
+CONFIG_DEFAULT = '~/.config/qtools/config'
+DEFAULT_BRANCH = 'master'
+
+config = None
+
+def read_config():
+    c = configparser.ConfigParser()
+    c.read(os.path.expanduser(CONFIG_DEFAULT))
+    return c
+
+# the file is only read once per process
+def load_config():
+    global config
+    if config is None:
+        config = read_config()
+    return config
+
+def write_config(c):
+    f = open(os.path.expanduser(CONFIG_DEFAULT), "w")
+    c.write(f)
+    f.close()
+
+# returns the name of the section for the repository set as name= (usually
+# default or upstream) in the repository section
+def get_repo_section(c, name):
+    if 'repository' not in c:
+        raise Exception("Repository section not found in the config file")
+    if name not in c['repository']:
+        raise Exception("No '%s' in repository section" % name)
+    section = "repo-%s" % c['repository'][name]
+    if section not in c:
+        raise Exception("No %s repository %s section exists" % (name, section))
+    return section
+
+def get_section_path(c, section):
+    if section not in c:
+        raise Exception("No %s section in the config file" % section)
+    if 'path' not in c[section]:
+        raise Exception("Repository section in the config file doesn't contain path=")
+    return c[section]['path']
+
+def get_section_branch(c, section):
+    if 'branch' not in c[section]:
+        return DEFAULT_BRANCH
+    return c[section]['branch']
+
+def get_repo_path(c, name):
+    return get_section_path(c, get_repo_section(c, name))
+
+def get_repo_branch(c, name):
+    return get_section_branch(c, get_repo_section(c, name))
@@ -0,0 +1,278 @@
+# Packed on-disk indexes used by the qtools caches.
+#
+# An index file holds one or more tables, each one mapping fixed size binary
+# keys (usually a sha) to a list of fixed size values, much like git's pack
+# .idx files:
+#
+#   header:  "QTIX", version, number of tables
+#   table:   key size, value size, number of keys
+#            fanout[256]: number of keys whose first byte is <= i
+#            keys[count], sorted
+#            offsets[count + 1]: index of the first value of each key
+#            values[offsets[count]]
+#
+# All integers are 32 bit big endian. Files are always rewritten as a whole
+# (atomically) and read through mmap, so a lookup only touches the pages
+# needed by the binary search.
+import os
+import mmap
+import struct
+
+INDEX_MAGIC = b'QTIX'
+INDEX_VERSION = 1
+DEFAULT_ENTRY_SIZE = 20
+
+class _Table:
+    __slots__ = ('key_size', 'value_size', 'count', 'fanout', 'keys', 'offsets', 'values')
+
+class PackedIndex:
+    def __init__(self, filename):
+        self.filename = filename
+        self.map = None
+        self.tables = None
+
+    # the file is only mapped on the first lookup
+    def _load(self):
+        if self.tables is not None:
+            return
+        self.tables = []
+        try:
+            f = open(self.filename, "rb")
+        except FileNotFoundError:
+            return
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if self.map[:4] != INDEX_MAGIC:
+            raise Exception("%s is not a qtools index file" % self.filename)
+        (version, ntables) = struct.unpack_from(">II", self.map, 4)
+        if version != INDEX_VERSION:
+            raise Exception("%s: unsupported index version %d" % (self.filename, version))
+
+        pos = 12
+        for i in range(ntables):
+            t = _Table()
+            (t.key_size, t.value_size, t.count) = struct.unpack_from(">III", self.map, pos)
+            pos += 12
+            t.fanout = pos
+            pos += 256 * 4
+            t.keys = pos
+            pos += t.count * t.key_size
+            t.offsets = pos
+            pos += (t.count + 1) * 4
+            t.values = pos
+            pos += self._offset(t, t.count) * t.value_size
+            self.tables.append(t)
+
+    def _table(self, table):
+        self._load()
+        if table >= len(self.tables):
+            return None
+        return self.tables[table]
+
+    def _offset(self, t, i):
+        return struct.unpack_from(">I", self.map, t.offsets + i * 4)[0]
+
+    def _key(self, t, i):
+        pos = t.keys + i * t.key_size
+        return self.map[pos:pos + t.key_size]
+
+    def _values(self, t, i):
+        output = []
+        start = self._offset(t, i)
+        end = self._offset(t, i + 1)
+        for n in range(start, end):
+            pos = t.values + n * t.value_size
+            output.append(self.map[pos:pos + t.value_size])
+        return output
+
+    # returns the position of key in the table, -1 if it's not there
+    def _find(self, t, key):
+        if t is None or t.count == 0 or len(key) != t.key_size:
+            return -1
+
+        lo = 0
+        if key[0] > 0:
+            lo = struct.unpack_from(">I", self.map, t.fanout + (key[0] - 1) * 4)[0]
+        hi = struct.unpack_from(">I", self.map, t.fanout + key[0] * 4)[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = self._key(t, mid)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def lookup(self, key, table=0):
+        t = self._table(table)
+        i = self._find(t, key)
+        if i < 0:
+            return []
+        return self._values(t, i)
+
+    def contains(self, key, table=0):
+        return self._find(self._table(table), key) >= 0
+
+    def items(self, table=0):
+        t = self._table(table)
+        if t is None:
+            return
+        for i in range(t.count):
+            yield (self._key(t, i), self._values(t, i))
+
+    def to_dict(self, table=0):
+        return dict(self.items(table))
+
+    def table_count(self):
+        self._load()
+        return len(self.tables)
+
+    def count(self, table=0):
+        t = self._table(table)
+        if t is None:
+            return 0
+        return t.count
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        self.tables = None
+
+def _write_table(f, table):
+    keys = sorted(table)
+
+    key_size = DEFAULT_ENTRY_SIZE
+    if len(keys) > 0:
+        key_size = len(keys[0])
+    value_size = DEFAULT_ENTRY_SIZE
+    for k in keys:
+        if len(table[k]) > 0:
+            value_size = len(table[k][0])
+            break
+
+    fanout = [0] * 256
+    offsets = []
+    n = 0
+    for k in keys:
+        if len(k) != key_size:
+            raise Exception("Index keys must have the same size (%d != %d)" % (len(k), key_size))
+        for v in table[k]:
+            if len(v) != value_size:
+                raise Exception("Index values must have the same size (%d != %d)" % (len(v), value_size))
+        fanout[k[0]] += 1
+        offsets.append(n)
+        n += len(table[k])
+    offsets.append(n)
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    f.write(struct.pack(">III", key_size, value_size, len(keys)))
+    f.write(struct.pack(">256I", *fanout))
+    f.write(b''.join(keys))
+    f.write(struct.pack(">%dI" % len(offsets), *offsets))
+    for k in keys:
+        f.write(b''.join(table[k]))
+
+# each table is a dictionary of bytes -> list of bytes
+def write_index(filename, *tables):
+    tmp = "%s.tmp-%d" % (filename, os.getpid())
+    f = open(tmp, "wb")
+    try:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack(">II", INDEX_VERSION, len(tables)))
+        for table in tables:
+            _write_table(f, table)
+        f.close()
+    except:
+        f.close()
+        os.unlink(tmp)
+        raise
+    os.replace(tmp, filename)
+
+# Indexes updated often can keep what changed in a small <filename>.delta
+# index next to the big one, so an update only rewrites the delta. Its first
+# table has the values added to each key, the second one has the values
+# removed from every key as keys. The delta is merged into the big index once
+# it has more than DELTA_MIN_KEYS keys and 1/8 of the big one's. Added values
+# go in front of the current ones with newest_first, after them otherwise
+DELTA_SUFFIX = '.delta'
+DELTA_MIN_KEYS = 16384
+
+def delta_filename(filename):
+    return filename + DELTA_SUFFIX
+
+def _merge_values(current, added, newest_first):
+    if newest_first:
+        return added + [v for v in current if v not in added]
+    return current + [v for v in added if v not in current]
+
+class DeltaIndex:
+    def __init__(self, filename, newest_first=True):
+        self.filename = filename
+        self.newest_first = newest_first
+        self.base = PackedIndex(filename)
+        self.delta = PackedIndex(delta_filename(filename))
+
+    def lookup(self, key):
+        current = [v for v in self.base.lookup(key) if not self.delta.contains(v, 1)]
+        return _merge_values(current, self.delta.lookup(key, 0), self.newest_first)
+
+    def close(self):
+        self.base.close()
+        self.delta.close()
+
+# adds the values in added (a dictionary of bytes -> list of bytes) and
+# removes the values in removed from every key. With replace, the current
+# contents are dropped instead
+def update_delta_index(filename, added, removed=(), replace=False, newest_first=True):
+    delta = delta_filename(filename)
+    if replace:
+        write_index(filename, added)
+        if os.path.exists(delta):
+            os.unlink(delta)
+        return
+    if len(added) == 0 and len(removed) == 0:
+        return
+
+    index = PackedIndex(delta)
+    delta_added = index.to_dict(0)
+    delta_removed = set(index.to_dict(1))
+    index.close()
+
+    removed = set(removed)
+    for k in list(delta_added):
+        delta_added[k] = [v for v in delta_added[k] if v not in removed]
+        if len(delta_added[k]) == 0:
+            del delta_added[k]
+    added_values = set()
+    for k, values in added.items():
+        delta_added[k] = _merge_values(delta_added.get(k, []), values, newest_first)
+        added_values.update(values)
+    delta_removed = (delta_removed | removed) - added_values
+
+    base = PackedIndex(filename)
+    size = len(delta_added) + len(delta_removed)
+    if os.path.exists(filename) and (size <= DELTA_MIN_KEYS or size <= base.count() // 8):
+        base.close()
+        write_index(delta, delta_added, dict([(v, []) for v in delta_removed]))
+        return
+
+    table = base.to_dict()
+    base.close()
+    for k in list(table):
+        table[k] = [v for v in table[k] if v not in delta_removed]
+        if len(table[k]) == 0:
+            del table[k]
+    for k, values in delta_added.items():
+        table[k] = _merge_values(table.get(k, []), values, newest_first)
+    write_index(filename, table)
+    if os.path.exists(delta):
+        os.unlink(delta)
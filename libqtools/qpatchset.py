@@ -0,0 +1,111 @@
+# Finding the other commits of the patchset a commit was merged with
+import sys
+import subprocess
+import collections
+
+# We only look at patches committed within 10min of the target one
+DEFAULT_COMMIT_INTERVAL = 600
+
+# list_patchset() results by (branch tip, commit, interval)
+patchset_cache = dict()
+branch_tips = dict()
+
+def get_branch_tip(path, branch):
+    if (path, branch) not in branch_tips:
+        branch_tips[(path, branch)] = subprocess.check_output(["git", "-C", path, "rev-parse", "%s^{commit}" % branch]).decode().strip()
+    return branch_tips[(path, branch)]
+
+# The patchset of one commit: the run of commits from its author, in git log
+# order, that contains it, within interval seconds of its commit date
+class PatchsetWindow:
+    def __init__(self, commit, interval):
+        self.commit = commit
+        self.email = commit.author_email
+        # what git log --min-age would show and where we stop looking
+        self.newest = commit.committed_date + interval - 1
+        self.oldest = commit.committed_date - interval
+        self.shas = []
+        self.found_commit = False
+
+    # takes the next git log entry, returns True once the patchset is
+    # complete
+    def feed(self, sha, committed_date, email):
+        if committed_date > self.newest:
+            return False
+        if committed_date < self.oldest:
+            # we're done looking
+            return True
+        if sha == self.commit.hexsha:
+            self.found_commit = True
+        if email == self.email:
+            self.shas.append(sha)
+            return False
+        if self.found_commit:
+            # we did it,
+            return True
+        # author might have changed and we didn't find the target commit
+        self.shas.clear()
+        return False
+
+# gets the patchsets of every commit from a single git log: it starts at the
+# newest window and each window is only fed the entries from its start until
+# it's complete, so the history is read once for the whole list.
+# repo is a gitbatch.Repository and commits gitbatch.Commits. Returns a
+# dictionary sha -> (commits, shas) like list_patchset()
+def list_patchsets(repo, branch, interval, commits):
+    path = repo.path
+    tip = get_branch_tip(path, branch)
+
+    output = dict()
+    windows = []
+    for commit in commits:
+        key = (tip, commit.hexsha, interval)
+        if key in patchset_cache:
+            output[commit.hexsha] = patchset_cache[key]
+        elif commit.hexsha not in output:
+            output[commit.hexsha] = None
+            windows.append(PatchsetWindow(commit, interval))
+    if len(windows) == 0:
+        return output
+
+    pending = collections.deque(sorted(windows, key=lambda w: w.newest, reverse=True))
+    active = []
+    proc = subprocess.Popen(["git", "-C", path, "log", "--format=%H %ct %ae",
+                             "--min-age=%d" % pending[0].newest, tip],
+                            stdout=subprocess.PIPE)
+    done = False
+    try:
+        for line in proc.stdout:
+            (sha, committed_date, email) = line.decode('utf-8', errors='replace').rstrip('\n').split(' ', 2)
+            committed_date = int(committed_date)
+            while len(pending) > 0 and pending[0].newest >= committed_date:
+                active.append(pending.popleft())
+            active = [w for w in active if not w.feed(sha, committed_date, email)]
+            if len(pending) == 0 and len(active) == 0:
+                done = True
+                break
+    finally:
+        proc.stdout.close()
+        if done:
+            proc.kill()
+        rc = proc.wait()
+    if not done and rc != 0:
+        raise Exception("Unable to read the history of %s (git log returned %d)" % (branch, rc))
+
+    for w in windows:
+        commit = w.commit
+        if len(w.shas) == 0:
+            sys.stderr.write("Commit %s not found in branch %s. Specify a different repo or branch\n" % (commit, branch))
+            sys.stderr.write("Until an option is implemented to do this automatically, run 'git branch -a --contains %s'\n" % commit)
+            output[commit.hexsha] = ([], [])
+            continue
+        commit_list = [repo.lazy_commit(sha) for sha in w.shas]
+        commit_sha_list = list(reversed(w.shas))
+        patchset_cache[(tip, commit.hexsha, interval)] = (commit_list, commit_sha_list)
+        output[commit.hexsha] = (commit_list, commit_sha_list)
+    return output
+
+# gets a list of patches in the same patchset by considering date and author
+# repo is a gitbatch.Repository and commit a gitbatch.Commit
+def list_patchset(repo, branch, interval, commit):
+    return list_patchsets(repo, branch, interval, [commit])[commit.hexsha]
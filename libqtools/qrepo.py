@@ -0,0 +1,18 @@
+# Each repository is only opened once per process. Objects are read through
+# long running git processes (see gitbatch), which only start when used.
+import subprocess
+from libqtools import gitbatch
+
+repos = dict()
+
+def get_repo(path):
+    repo = repos.get(path)
+    if repo is None:
+        proc = subprocess.run(["git", "-C", path, "rev-parse", "--git-dir"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            error = proc.stderr.decode('utf-8', errors='replace').strip()
+            raise Exception("Unable to open git repo at %s (%s)" % (path, error))
+        repo = gitbatch.Repository(path)
+        repos[path] = repo
+    return repo
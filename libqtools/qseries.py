@@ -0,0 +1,59 @@
+# Reading the quilt series and the upstream commits its patches come from
+import sys
+import re
+
+_commit_re = re.compile('^commit ([a-f0-9]{40})')
+_cherry_pick_re = re.compile('^.*cherry picked from commit ([a-f0-9]{40}).*')
+_rhel_only_re = re.compile('^[uU]pstream.[sS]tatus:.[rR][hH][eE][lL]-[oO]nly')
+
+# returns the patch names in patches/series, without comments and options
+def read_series():
+    try:
+        f = open("patches/series", "r")
+        series = []
+        for patch in f.readlines():
+            if patch.startswith('#') or len(patch.split()) == 0:
+                continue
+            series.append(patch.split()[0])
+        f.close()
+    except Exception as error:
+        raise Exception("Unable to open patch/series (%s)" % str(error))
+    return series
+
+# returns the applied patches as quilt keeps them, the top one last
+def read_applied():
+    try:
+        f = open(".pc/applied-patches", "r")
+    except FileNotFoundError:
+        return []
+    applied = [l.strip() for l in f.readlines() if len(l.strip()) > 0]
+    f.close()
+    return applied
+
+# returns the upstream commit of an open patch file, None if it has none
+def get_commit_sha(f):
+    for l in f:
+        res = _commit_re.match(l)
+        if res:
+            return res.group(1)
+        res = _cherry_pick_re.match(l)
+        if res:
+            return res.group(1)
+        res = _rhel_only_re.match(l)
+        if res:
+            return None
+    sys.stderr.write("Warning: commit not found for: %s\n" % f.name)
+    return None
+
+def get_series_commits():
+    series = []
+    for patch in read_series():
+        try:
+            p = open("patches/%s" % patch, "r")
+        except Exception as error:
+            raise Exception("Unable to open patch/series (%s)" % str(error))
+        c = get_commit_sha(p)
+        p.close()
+        if c is not None:
+            series.append(c)
+    return series
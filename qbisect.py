@@ -0,0 +1,250 @@
+#!/bin/env python3
+# Bisects a quilt series: patches are pushed or popped to the middle of the
+# last good and the first bad patch until the one breaking things is found.
+# Every step goes to BISECT_LOG, which is all the state there is, so an
+# interrupted bisection carries on where it was
+import sys
+import os
+import optparse
+import subprocess
+from libqtools.qseries import read_series, read_applied
+
+BISECT_LOG = '.qbisect-log'
+# exit code of a qbisect run command for a patch that can't be tested
+SKIP_CODE = 125
+
+class BisectState:
+    def __init__(self, series):
+        self.series = series
+        self.positions = dict()
+        for i, p in enumerate(series):
+            self.positions.setdefault(p, i)
+        self.good = None
+        self.bad = None
+        self.skipped = set()
+
+    def mark(self, what, patch):
+        if patch not in self.positions:
+            raise Exception("patch %s not found in the series" % patch)
+        n = self.positions[patch]
+        if what == 'good':
+            self.good = n
+        elif what == 'bad':
+            self.bad = n
+        elif what == 'skip':
+            self.skipped.add(n)
+        else:
+            raise Exception("%s is not a valid operation" % what)
+
+    def ready(self):
+        return self.good is not None and self.bad is not None
+
+    def check(self):
+        if self.good >= self.bad:
+            raise Exception("bad patch comes earlier than the good patch?!? (%s, %s)" % (self.series[self.bad], self.series[self.good]))
+
+    # the patches that still need to be tested
+    def remaining(self):
+        return [i for i in range(self.good + 1, self.bad) if i not in self.skipped]
+
+    # returns the patch to test next, the closest to the middle that wasn't
+    # skipped, or None once it's done
+    def next(self):
+        self.check()
+        middle = self.good + (self.bad - self.good) // 2
+        for distance in range(0, self.bad - self.good):
+            for n in (middle - distance, middle + distance):
+                if n > self.good and n < self.bad and n not in self.skipped:
+                    return n
+        return None
+
+    # returns the patches that can be the culprit once it's done, more than
+    # one if some had to be skipped
+    def culprits(self):
+        return [self.series[n] for n in range(self.good + 1, self.bad + 1)]
+
+# returns [(what, patch)] from a bisect log
+def read_log(filename):
+    try:
+        f = open(filename, "r")
+    except FileNotFoundError:
+        raise Exception("Not bisecting, use qbisect start first")
+    entries = []
+    for l in f.readlines():
+        l = l.strip()
+        if len(l) == 0 or l[0] == '#':
+            continue
+        fields = l.split()
+        if len(fields) != 2:
+            raise Exception("Invalid line in %s: %s" % (filename, l))
+        entries.append((fields[0], fields[1]))
+    f.close()
+    return entries
+
+def write_log(*lines):
+    f = open(BISECT_LOG, "a")
+    for l in lines:
+        f.write("%s\n" % l)
+    f.close()
+
+def load_state(filename=BISECT_LOG):
+    state = BisectState(read_series())
+    for (what, patch) in read_log(filename):
+        state.mark(what, patch)
+    return state
+
+def get_top():
+    applied = read_applied()
+    if len(applied) == 0:
+        return None
+    return applied[-1]
+
+# pushes or pops patches until patch is the top one
+def go_to(patch):
+    applied = read_applied()
+    if len(applied) > 0 and applied[-1] == patch:
+        return
+    if patch in applied:
+        cmd = "pop"
+    else:
+        cmd = "push"
+    sys.stdout.flush()
+    rc = subprocess.call(["quilt", cmd, "-q", patch])
+    if rc != 0:
+        raise Exception("Error getting to %s (quilt %s returned %d)" % (patch, cmd, rc))
+
+# moves to the next patch to test. Returns True once it's done
+def step(state):
+    n = state.next()
+    if n is None:
+        culprits = state.culprits()
+        if len(culprits) == 1:
+            print("Culprit:")
+        else:
+            print("Skipped patches were left, the culprit is one of:")
+        for p in culprits:
+            print(p)
+        return True
+
+    left = len(state.remaining()) - 1
+    print("Bisecting: %d patches left to test after this (roughly %d steps)" % (left, left.bit_length()))
+    go_to(state.series[n])
+    return False
+
+def mark(state, what, patch):
+    if patch is None:
+        patch = get_top()
+        if patch is None:
+            raise Exception("sorry, %s must be a patch" % what)
+    state.mark(what, patch)
+    if state.ready():
+        state.check()
+    write_log("%s %s" % (what, patch))
+    if state.ready():
+        step(state)
+
+# runs cmd at every step, its exit code tells if the patch is good (0), bad
+# (1 to 127) or can't be tested (125)
+def run(state, cmd):
+    if not state.ready():
+        raise Exception("Both a good and a bad patch are needed, use qbisect good and bad first")
+
+    while True:
+        n = state.next()
+        if n is None:
+            step(state)
+            return 0
+        patch = state.series[n]
+        go_to(patch)
+
+        print("running %s" % ' '.join(cmd))
+        sys.stdout.flush()
+        if len(cmd) == 1:
+            rc = subprocess.call(cmd[0], shell=True)
+        else:
+            rc = subprocess.call(cmd)
+        if rc < 0 or rc > 127:
+            sys.stderr.write("qbisect run: %s exited with %d, stopping at %s\n" % (' '.join(cmd), rc, patch))
+            return 1
+        if rc == 0:
+            what = 'good'
+        elif rc == SKIP_CODE:
+            what = 'skip'
+        else:
+            what = 'bad'
+
+        print("%s is %s" % (patch, what))
+        state.mark(what, patch)
+        write_log("# run: %s exited with %d" % (' '.join(cmd), rc), "%s %s" % (what, patch))
+        if state.next() is not None:
+            step(state)
+
+def main(argv):
+    usage = "usage: %prog <start [bad [good]] | good [patch] | bad [patch] | skip [patch] | run <cmd> | log | replay <file> | reset>"
+    parser = optparse.OptionParser(usage=usage)
+    # the options after run belong to the command
+    parser.disable_interspersed_args()
+    (options, args) = parser.parse_args(argv[1:])
+
+    if len(args) < 1:
+        parser.print_usage()
+        return 1
+    cmd = args[0]
+    args = args[1:]
+
+    try:
+        if cmd == 'start':
+            f = open(BISECT_LOG, "w")
+            f.write("# qbisect start\n")
+            f.close()
+            state = load_state()
+            if len(args) > 0:
+                mark(state, 'bad', args[0])
+            if len(args) > 1:
+                mark(state, 'good', args[1])
+        elif cmd == 'reset':
+            try:
+                os.unlink(BISECT_LOG)
+            except FileNotFoundError:
+                pass
+        elif cmd in ['good', 'bad', 'skip']:
+            if len(args) > 1:
+                parser.print_usage()
+                return 1
+            state = load_state()
+            mark(state, cmd, args[0] if len(args) > 0 else None)
+        elif cmd == 'log':
+            if not os.path.exists(BISECT_LOG):
+                raise Exception("Not bisecting, use qbisect start first")
+            f = open(BISECT_LOG, "r")
+            sys.stdout.write(f.read())
+            f.close()
+        elif cmd == 'replay':
+            if len(args) != 1:
+                parser.print_usage()
+                return 1
+            state = load_state(args[0])
+            f = open(args[0], "r")
+            log = f.read()
+            f.close()
+            f = open(BISECT_LOG, "w")
+            f.write(log)
+            f.close()
+            if state.ready():
+                step(state)
+        elif cmd == 'run':
+            if len(args) == 0:
+                parser.print_usage()
+                return 1
+            return run(load_state(), args)
+        else:
+            sys.stderr.write("%s is not a valid operation\n" % cmd)
+            return 1
+    except Exception as ex:
+        sys.stderr.write("%s\n" % str(ex))
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
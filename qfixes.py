@@ -1,200 +1,454 @@
 #!/bin/env python3
 import sys
 import os
-import configparser
-import git
 import optparse
-import datetime
-import difflib
 import errno
 import re
+import collections
+import subprocess
+import multiprocessing
 import warnings
 import shutil
+import hashlib
+from libqtools import qindex
+from libqtools import qclient
+from libqtools import qconfig
+from libqtools import qrepo
+from libqtools import gitbatch
+from libqtools.qseries import get_series_commits
 warnings.filterwarnings("ignore")
 
-CONFIG_DEFAULT = '~/.config/qtools/config'
-# we can add an option to specify branch and another to do it automatically (git branch -a --contains <sha>)
-DEFAULT_BRANCH = 'master'
-
-commit_cache = dict()
-repeated_names = []
-
-def cache_commits(repo, branch):
-    for c in repo.iter_commits(branch):
-        summary = c.summary.lower()
-        if summary in commit_cache:
-            repeated_names.append(summary)
-            continue
-        commit_cache[summary] = c.hexsha
-
-def find_commit_by_name(repo, branch, name):
-    found = []
+FIXES_INDEX = 'fixes.idx'
+SUMMARY_INDEX = 'summaries.idx'
+# directories used by the old one file per commit cache
+OLD_CACHE_DIRS = ['a','b','c','d','e','f', '0','1','2','3','4','5','6','7','8','9']
+
+# summary index, opened on the first lookup
+summary_indexes = dict()
+
+def get_summary_index_filename(cache):
+    return "%s/%s" % (cache, SUMMARY_INDEX)
+
+def summary_key(summary):
+    return hashlib.sha1(summary.lower().encode('utf-8', errors='ignore')).digest()
+
+# adds the summary of every commit in revs to the summary index and drops the
+# commits in removed. New commits go first, the same order
+# find_commit_by_name() used to prefer. Only the index delta is rewritten,
+# unless replace is set
+def update_summary_index(path, cache, revs, removed=(), replace=False):
+    filename = get_summary_index_filename(cache)
+    if not os.path.exists(filename):
+        # it didn't exist when the fixes cache was populated
+        revs = [r for r in revs if not r.startswith('^')]
+
+    summaries = dict()
+    proc = subprocess.Popen(["git", "-C", path, "log", "--format=%H%x00%s%x00"] + revs + ["--"], stdout=subprocess.PIPE)
+    for (sha, summary) in read_log_stream(proc.stdout):
+        key = summary_key(decode_message(summary))
+        summaries.setdefault(key, []).append(bytes.fromhex(sha))
+    proc.stdout.close()
+    rc = proc.wait()
+    if rc != 0:
+        raise Exception("Unable to read history from %s (git log returned %d)" % (path, rc))
+
+    qindex.update_delta_index(filename, summaries, removed, replace)
+
+# returns the sha of the commit with the given summary
+def find_commit_by_name(cache, name):
+    index = summary_indexes.get(cache)
+    if index is None:
+        index = qindex.DeltaIndex(get_summary_index_filename(cache))
+        summary_indexes[cache] = index
+
+    found = index.lookup(summary_key(name))
+    if len(found) == 0:
+        return None
+    hexsha = found[0].hex()
+    if len(found) > 1:
+        sys.stderr.write("Warning: filtering commits by name (%s) resulted in more than one commit (%s). Using only %s\n" % (name, ' '.join([c.hex() for c in found]), hexsha))
+    return hexsha
+
+# only commits matching one of these are read with the default scan
+FIXES_GREP = ['Fixes:', 'reverts commit']
+
+_fixes_re = re.compile(rb'Fixes: ([0-9a-f]+) ([^\n]*)')
+_fixes_summary_re = re.compile(rb'\((.*)\)')
+_revert_re = re.compile(rb'This reverts commit ([0-9a-f]+)\.')
+
+def decode_message(msg):
+    try:
+        return msg.decode('utf-8', errors='ignore')
+    except:
+        return msg.decode('iso8859-1', errors='ignore')
+
+# returns (fixed commit, summary) from a raw commit message. As before, the
+# last Fixes: tag wins and reverts are only considered without one
+def match_fixes(msg):
+    match = _fixes_re.findall(msg)
+    if match:
+        (sha, rest) = match[-1]
+        summary = None
+        match_complete = _fixes_summary_re.search(rest)
+        if match_complete:
+            summary = decode_message(match_complete.group(1))
+            summary = summary.replace('"','').replace('[PATCH] ','').replace("'",'')
+        return (sha.decode(), summary)
+
+    match = _revert_re.findall(msg)
+    if match:
+        return (match[-1].decode(), None)
+    return None
 
-    if len(commit_cache) == 0:
-        cache_commits(repo, branch)
+# splits the output of git log --format=%H%x00%B%x00 in (sha, message)
+def read_log_stream(f):
+    buf = b''
+    fields = []
+    while True:
+        data = f.read(1 << 20)
+        if not data:
+            break
+        buf += data
+        parts = buf.split(b'\0')
+        buf = parts.pop()
+        for p in parts:
+            fields.append(p)
+            if len(fields) == 2:
+                yield (fields[0].strip().decode(), fields[1])
+                fields = []
+
+# yields (fixing commit, fixed commit, summary) for each commit in revs that
+# has a Fixes: or revert tag. Messages are read straight from a single git log
+# and never turned into objects
+def scan_history(path, revs, prefilter=True):
+    cmd = ["git", "-C", path, "log", "--format=%H%x00%B%x00"]
+    if prefilter:
+        for g in FIXES_GREP:
+            cmd.append("--grep=%s" % g)
+    cmd += revs
+    cmd.append("--")
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        for (sha, msg) in read_log_stream(proc.stdout):
+            match = match_fixes(msg)
+            if match:
+                yield (sha, match[0], match[1])
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    if rc != 0:
+        raise Exception("Unable to read history from %s (git log returned %d)" % (path, rc))
+
+# returns a list of (fixed, fixing) binary shas found in revs
+def scan_fixes(repo, path, cache, revs, prefilter=True):
+    output = []
+    for (sha, fixed, summary) in scan_history(path, revs, prefilter):
+        commit = repo.resolve_commit(fixed)
+        if commit is None:
+            if summary:
+                commit = find_commit_by_name(cache, summary)
+            if not commit:
+                sys.stderr.write("Warning: commit %s fixes %s but %s can't be found\n" % (sha, fixed, fixed))
+                continue
 
-    summary = name.lower()
-    if summary in commit_cache:
-        hexsha = commit_cache[summary]
-        if summary in repeated_names:
-            sys.stderr.write("Warning: filtering commits by name (%s) resulted in more than one commit. Using only %s\n" % (name, hexsha))
-        return repo.commit(hexsha)
-    return None
+        output.append((bytes.fromhex(commit), bytes.fromhex(sha)))
+    return output
 
-def update_cache(repo, cache, branch, last):
+# runs in the worker processes
+def scan_chunk(args):
+    (path, cache, revs, prefilter) = args
+    repo = qrepo.get_repo(path)
+    return scan_fixes(repo, path, cache, revs, prefilter)
+
+# splits tip ^exclude in disjoint ranges using commits in the first parent
+# chain as boundaries: everything reachable from a boundary but not from the
+# next one belongs to the same chunk
+def split_range(path, tip, exclude, chunks):
+    cmd = ["git", "-C", path, "rev-list", "--first-parent", tip]
+    cmd += ["^%s" % e for e in exclude]
+    chain = subprocess.check_output(cmd).decode().split()
+
+    step = max(1, -(-len(chain) // chunks))
+    bounds = chain[::step]
+    ranges = []
+    for i, b in enumerate(bounds):
+        revs = [b]
+        if i + 1 < len(bounds):
+            revs.append("^%s" % bounds[i + 1])
+        revs += ["^%s" % e for e in exclude]
+        ranges.append(revs)
+    return ranges
+
+# returns the commits whose history was already scanned and the commits that
+# were scanned but aren't in the branch anymore. If the branch was rewritten
+# since the last update, only what isn't shared with the old tip needs to be
+# scanned again. Nothing is scanned already when everything has to be scanned.
+# Commits still reachable from the others, the last scanned commits of the
+# other branches, are never dropped
+def get_scanned(repo, tip, last, others=()):
+    if not last:
+        return ([], [])
+    found = repo.resolve_commit(last)
+    if found is None:
+        sys.stderr.write("Warning: last scanned commit %s not found, scanning everything\n" % last)
+        return ([], [])
+    last = found
+
+    if repo.is_ancestor(last, tip):
+        return ([last], [])
+
+    bases = repo.merge_bases(last, tip)
+    if len(bases) == 0:
+        sys.stderr.write("Warning: last scanned commit %s has nothing in common with %s, scanning everything\n" % (last, tip))
+        return ([], [])
+    sys.stderr.write("Warning: last scanned commit %s is not in %s anymore, scanning from %s\n" % (last, tip, ' '.join(bases)))
+    dropped = [c.binsha for c in repo.iter_commits([last, "^%s" % tip] + ["^%s" % b for b in bases] + ["^%s" % o for o in others])]
+    return (bases, dropped)
+
+# the indexes are shared by all the branches, others are the last scanned
+# commits of the other branches
+def update_cache(repo, path, cache, branch, last, prefilter=True, jobs=1, others=()):
     try:
         os.mkdir(cache)
     except OSError as error:
         if error.errno != errno.EEXIST:
             raise(error)
 
-    for c in ['a','b','c','d','e','f', '0','1','2','3','4','5','6','7','8','9']:
+    # everything is scanned up to the tip we have now, even if the branch
+    # moves in the meantime, so it's safe to record it as last
+    ret = repo.resolve_commit(branch)
+    if ret is None:
+        raise Exception("Unable to find %s in %s" % (branch, path))
+    others = [o for o in [repo.resolve_commit(o) for o in others] if o is not None]
+    (exclude, dropped) = get_scanned(repo, ret, last, others)
+    # a full scan replaces whatever the indexes had, unless other branches
+    # were scanned into them too
+    replace = len(exclude) == 0 and len(others) == 0
+
+    revs = [ret] + ["^%s" % e for e in exclude]
+    # needed to resolve Fixes: tags by name
+    update_summary_index(path, cache, revs, dropped, replace)
+
+    if jobs > 1:
+        # more chunks than processes so a slow chunk doesn't hold everything
+        ranges = split_range(path, ret, exclude, jobs * 4)
+        pool = multiprocessing.Pool(jobs)
         try:
-            os.mkdir("%s/%s" % (cache, c))
-        except OSError as error:
-            if error.errno != errno.EEXIST:
-                raise(error)
-
-    regex = re.compile('.*Fixes:\ ([0-9a-f]+)\ .*', re.S)
-    regex_complete = re.compile('.*Fixes:\ ([0-9a-f]+)\ \((.*)\).*', re.S)
-    revert_regex = re.compile('.*This\ reverts\ commit\ ([0-9a-f]+)\..*', re.S)
-    ret = None
-    for c in repo.iter_commits(branch):
-        if ret is None:
-            ret = c.hexsha
-        if c.hexsha == last:
-            break
+            results = pool.map(scan_chunk, [(path, cache, r, prefilter) for r in ranges], 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [scan_fixes(repo, path, cache, revs, prefilter)]
+
+    # chunks are ordered from the tip, so the merge doesn't depend on which
+    # worker finished first
+    fixes = dict()
+    for result in results:
+        for (commit, sha) in result:
+            fixes.setdefault(commit, []).append(sha)
+
+    write_fixes_index(cache, fixes, dropped, replace)
+    return ret
 
-        msg = c.message
-        if type(msg) is bytes:
+def get_index_filename(cache):
+    return "%s/%s" % (cache, FIXES_INDEX)
+
+# merges fixed -> fixing commits in the packed index and drops the fixing
+# commits in removed, new fixes go after the ones already known. Only the
+# index delta is rewritten, unless replace is set
+def write_fixes_index(cache, fixes, removed=(), replace=False):
+    qindex.update_delta_index(get_index_filename(cache), fixes, removed, replace, newest_first=False)
+
+# converts the old <cache>/<first hex>/<sha> files into the packed index
+def migrate_cache(cache):
+    dirs = []
+    for c in OLD_CACHE_DIRS:
+        directory = "%s/%s" % (cache, c)
+        if os.path.isdir(directory):
+            dirs.append(directory)
+    if len(dirs) == 0:
+        return
+
+    sys.stderr.write("Migrating fixes cache in %s to %s\n" % (cache, FIXES_INDEX))
+    fixes = dict()
+    for directory in dirs:
+        for name in os.listdir(directory):
             try:
-                msg = msg.decode('utf-8', errors='ignore')
-            except Exception as error:
-                msg = None
-                pass
-            if msg is None:
-                msg = msg.decode('iso8859-1', errors='ignore')
-
-        summary = None
-        match = re.match(regex, msg)
-        if match:
-            match_complete = re.match(regex_complete, msg)
-            if match_complete:
-                summary = match_complete.group(2).replace('"','').replace('[PATCH] ','').replace("'",'')
-        else:
-            match = re.match(revert_regex, msg)
-        if not match:
-            continue
-
-        try:
-            commit = repo.commit(match.group(1))
-        except:
-            if summary:
-                commit = find_commit_by_name(repo, branch, summary)
-            if not commit:
-                sys.stderr.write("Warning: commit %s fixes %s but %s can't be found\n" % (c.hexsha, match.group(1), match.group(1)))
-                pass
+                commit = bytes.fromhex(name)
+            except ValueError:
                 continue
-            pass
-
-        commit_sha = commit.hexsha
-        filename = "%s/%s/%s" % (cache, commit_sha[0], commit_sha)
-        try:
-            f = open(filename, "r")
-            lines = f.readlines()
+            f = open("%s/%s" % (directory, name), "r")
+            for l in f.readlines():
+                l = l.strip()
+                if len(l) == 40:
+                    fixes.setdefault(commit, []).append(bytes.fromhex(l))
             f.close()
-            if c.hexsha + "\n" in lines:
-                continue
-        except:
-            pass
 
-        f = open(filename, "a+")
-        f.write("%s\n" % c.hexsha)
-        f.close()
-    return ret
+    write_fixes_index(cache, fixes)
+    for directory in dirs:
+        shutil.rmtree(directory)
 
-def get_fixes_from_cache(cache, commit_sha):
-    output = []
+def open_fixes_index(cache):
+    migrate_cache(cache)
+    return qindex.DeltaIndex(get_index_filename(cache), newest_first=False)
+
+def purge_cache(cache):
+    for c in OLD_CACHE_DIRS:
+        shutil.rmtree("%s/%s" % (cache, c), ignore_errors=True)
+    for filename in [get_index_filename(cache), get_summary_index_filename(cache)]:
+        for f in [filename, qindex.delta_filename(filename)]:
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+
+def get_fixes_from_cache(index, commit_sha):
     try:
-        f = open("%s/%s/%s" %(cache, commit_sha[0], commit_sha), "r")
-        for c in f.readlines():
-            output.append(c.replace('\n', ''))
-    except:
-        pass
-    return output
+        key = bytes.fromhex(commit_sha)
+    except ValueError:
+        return []
+    return [c.hex() for c in index.lookup(key)]
+
+# walks the graph of commits fixing other commits. Lookups and visited
+# commits are shared by all walks, so anything reachable from more than one
+# series entry is only looked up and reported once
+class FixesWalker:
+    def __init__(self, index, verbose=False, log=sys.stderr.write):
+        self.index = index
+        self.verbose = verbose
+        self.log = log
+        self.lookups = dict()
+        self.visited = set()
+        # fix -> (commit it fixes, distance from the walk's starting commit)
+        self.parents = dict()
+
+    def lookup(self, commit_sha):
+        fixes = self.lookups.get(commit_sha)
+        if fixes is None:
+            fixes = get_fixes_from_cache(self.index, commit_sha)
+            self.lookups[commit_sha] = fixes
+        return fixes
+
+    # breadth first, returns the fixes not found by previous walks in the
+    # order they were found
+    def walk(self, commit_sha):
+        output = []
+        self.visited.add(commit_sha)
+        queue = collections.deque([(commit_sha, 0)])
+        while len(queue) > 0:
+            (c, depth) = queue.popleft()
+            for i in self.lookup(c):
+                if i in self.visited:
+                    continue
+                if self.verbose:
+                    self.log("%s is fixed by %s\n" % (c, i))
+                self.visited.add(i)
+                self.parents[i] = (c, depth + 1)
+                output.append(i)
+                queue.append((i, depth + 1))
+        return output
 
 # here we recursively look for patches that fix the given one
-def get_fixes_single(cache, commit_sha, verbose):
-    current_list = [commit_sha]
-    final_list = []
-
-    while len(current_list) > 0:
-        for c in current_list:
-            fixes = get_fixes_from_cache(cache, c)
-            for i in fixes:
-                if i not in current_list:
-                    current_list.append(i)
-                if i not in final_list:
-                    if verbose:
-                        sys.stderr.write("%s is fixed by %s\n" % (c, i))
-                    final_list.append(i)
-            current_list.remove(c)
-
-    return final_list
-
-def get_commit_sha(f):
-    regex = re.compile('^commit ([a-f0-9]{40})')
-    regex2 = re.compile('^.*cherry picked from commit ([a-f0-9]{40}).*')
-    regex3 = re.compile('^[uU]pstream.[sS]tatus:.[rR][hH][eE][lL]-[oO]nly')
-    for l in f.readlines():
-        res = regex.match(l)
-        if res:
-            return res.group(1)
-        res = regex2.match(l)
-        if res:
-            return res.group(1)
-        res = regex3.match(l)
-        if res:
-            return None
-    print("Warning: commit not found for: %s" % f.name)
-    return None
+def get_fixes_single(walker, commit_sha):
+    return walker.walk(commit_sha)
 
-def get_fixes(cache, verbose):
+def get_fixes(walker, series):
     output = []
-
-    try:
-        f = open("patches/series", "r")
-        series = []
-        for patch in f.readlines():
-            patch = patch.replace('\n', '')
-            if patch.startswith('#'):
-                continue
-            p = open("patches/%s" % patch, "r")
-            c = get_commit_sha(p)
-            p.close()
-            if c is not None:
-                series.append(c)
-        f.close()
-    except Exception as error:
-        raise Exception("Unable to open patch/series (%s)" % str(error))
-
+    series_set = set(series)
     for c in series:
-        fixes = get_fixes_single(cache, c, verbose)
-        for i in fixes:
-            if i not in output and i not in series:
+        for i in get_fixes_single(walker, c):
+            if i not in series_set:
                 output.append(i)
 
     return output
 
-def check_update_state(repo, last):
+# returns (fix, distance, fixed commit) for each fix
+def annotate_fixes(walker, fixes):
+    output = []
+    for c in fixes:
+        (parent, depth) = walker.parents[c]
+        output.append((c, depth, parent))
+    return output
+
+def print_fixes(fixes, annotate):
+    for (c, depth, parent) in fixes:
+        if annotate:
+            print("%s %d %s" % (c, depth, parent))
+        else:
+            print(c)
+
+# resolver is a gitbatch.CatFileCheck on the upstream repository
+def check_update_state(resolver, branch, last, log=sys.stderr.write):
     if last is None:
-        sys.stderr.write("Cache is not initialized, run with -u then try again\n")
+        log("Cache is not initialized, run with -u then try again\n")
     try:
-        commit = repo.commit('HEAD')
-        if commit.hexsha != last:
-            sys.stderr.write("Warning: cache is not up-to-date: last scanned commit: %s, HEAD is %s\n" % (last, commit.hexsha))
+        sha = resolver.resolve_commit(branch)
+        if sha is None:
+            log("Unable to get '%s' commit in the specified tree\n" % branch)
+        elif sha != last:
+            log("Warning: cache is not up-to-date: last scanned commit: %s, %s is %s\n" % (last, branch, sha))
     except Exception as error:
-        sys.stderr.write("Unable to get 'HEAD' commit in the specified tree (%s)\n" % str(error))
+        log("Unable to get '%s' commit in the specified tree (%s)\n" % (branch, str(error)))
+
+# each scanned branch has its own last-<branch> watermark. 'last' is from
+# when only master was scanned
+def get_last(config, branch):
+    key = "last-%s" % branch
+    if key in config['fixes']:
+        return config['fixes'][key] or None
+    if branch == qconfig.DEFAULT_BRANCH and 'last' in config['fixes']:
+        return config['fixes']['last'] or None
+    return None
+
+# returns the last scanned commits of every branch but this one
+def get_other_lasts(config, branch):
+    others = []
+    for key in config['fixes']:
+        if key == 'last':
+            other = qconfig.DEFAULT_BRANCH
+        elif key.startswith('last-'):
+            other = key[len('last-'):]
+        else:
+            continue
+        if other != branch and config['fixes'][key]:
+            others.append(config['fixes'][key])
+    return others
+
+def set_last(config, branch, last):
+    if branch == qconfig.DEFAULT_BRANCH and 'last' in config['fixes']:
+        del config['fixes']['last']
+    config['fixes']["last-%s" % branch] = last
+
+def clear_last(config):
+    for key in list(config['fixes']):
+        if key == 'last' or key.startswith('last-'):
+            del config['fixes'][key]
+
+def get_fixes_config(config):
+    path = qconfig.get_repo_path(config, 'upstream')
+    if 'fixes' not in config:
+        raise Exception("Fixes section not found in the config file")
+    if 'cache' not in config['fixes']:
+        raise Exception("Fixes section in the config file doesn't contain cache=")
+    return (path, config['fixes']['cache'])
+
+# returns None if qtoolsd isn't running
+def query_daemon(config, options):
+    if options.do_single:
+        commits = [options.do_single]
+    else:
+        commits = get_series_commits()
+    result = qclient.query(config, {'cmd': 'fixes', 'branch': options.branch, 'commits': commits,
+                                    'series': not options.do_single, 'verbose': options.do_verbose})
+    if result is None:
+        return None
+
+    sys.stderr.write(''.join(result['log']))
+    if not options.do_verbose:
+        print_fixes(result['fixes'][0], options.do_annotate)
+    return 0
 
 def main(argv):
     usage = "usage: %prog [options]"
@@ -202,80 +456,60 @@ def main(argv):
     parser.add_option("-u", "--update", dest="do_update", default=False, help="Update cache using configured git repository", action="store_true")
     parser.add_option("-p", "--purge", dest="do_purge", default=False, help="Purges cache, preparing for a new -u", action="store_true")
     parser.add_option("-s", "--single", dest="do_single", help="Only list fixes for a given COMMIT and ignores all patches already in series", metavar="COMMIT")
+    parser.add_option("-b", "--branch", dest="branch", default=qconfig.DEFAULT_BRANCH, help="Scan or check branch BRANCH in the upstream repository", metavar="BRANCH")
+    parser.add_option("-F", "--full-scan", dest="do_full_scan", default=False, help="With -u, read every commit message instead of letting git pick the ones with Fixes: or revert tags", action="store_true")
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int", help="With -u, scan history using JOBS processes", metavar="JOBS")
+    parser.add_option("-a", "--annotate", dest="do_annotate", default=False, help="Also show how far each fix is from the series commit and which commit it fixes", action="store_true")
     parser.add_option("-v", "--verbose", dest="do_verbose", default=False, help="Show the reason why each commit is picked as fix", action="store_true")
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv[1:])
 
     do_update = options.do_update
     do_verbose = options.do_verbose
     do_purge = options.do_purge
 
-    config = configparser.ConfigParser()
+    config = qconfig.load_config()
     try:
-        config.read(os.path.expanduser(CONFIG_DEFAULT))
-        if 'repository' not in config:
-            sys.stderr.write("Repository section not found in the config file\n")
-            return 1
-        if 'upstream' not in config['repository']:
-            sys.stderr.write("No 'upstream' in repository section\n")
-            return 1
-        upstream_repo = "repo-%s" % config['repository']['upstream'];
-        if upstream_repo not in config:
-            sys.stderr.write("No upstream repository %s section exists\n" % upstream_repo)
-            return 1
-        if 'path' not in config[upstream_repo]:
-            sys.stderr.write("Repository section in the config file doesn't contain path=\n")
-            return 1
-        path = config[upstream_repo]['path']
-        if 'fixes' not in config:
-            sys.stderr.write("Fixes section not found in the config file\n")
-            return 1
-        if 'cache' not in config['fixes']:
-            sys.stderr.write("Fixes section in the config file doesn't contain cache=\n")
-            return 1
-        cache = config['fixes']['cache']
-        last = None
-        if 'last' in config['fixes']:
-            last = config['fixes']['last']
+        (path, cache) = get_fixes_config(config)
     except Exception as ex:
-        sys.stderr.write("Unable to read the config file, which is mandatory for now\n")
-        raise(ex)
+        sys.stderr.write("%s\n" % str(ex))
         return 1
+    last = get_last(config, options.branch)
 
-    repo = git.Repo(path)
-    try:
-        repo = git.Repo(path)
-    except:
-        sys.stderr.write("Unable to open git repo at %s\n" % path)
-        return 1
+    if not do_update and not do_purge:
+        ret = query_daemon(config, options)
+        if ret is not None:
+            return ret
 
     if do_purge:
-        config['fixes']['last'] = ''
-        f = open(os.path.expanduser(CONFIG_DEFAULT), "w")
-        config.write(f)
-        f.close()
+        purge_cache(cache)
+        clear_last(config)
+        qconfig.write_config(config)
         return 0
 
     if do_update:
-        # for now, all we care is Linus' master branch
-        config['fixes']['last'] = update_cache(repo, cache, "master", last)
-        f = open(os.path.expanduser(CONFIG_DEFAULT), "w")
-        config.write(f)
-        f.close()
+        try:
+            repo = qrepo.get_repo(path)
+        except Exception as ex:
+            sys.stderr.write("%s\n" % str(ex))
+            return 1
+        migrate_cache(cache)
+        set_last(config, options.branch, update_cache(repo, path, cache, options.branch, last, not options.do_full_scan, options.jobs,
+                                                        get_other_lasts(config, options.branch)))
+        qconfig.write_config(config)
         return 0
 
-    check_update_state(repo, last)
+    resolver = gitbatch.CatFileCheck(path)
+    check_update_state(resolver, options.branch, last)
+    resolver.close()
+    index = open_fixes_index(cache)
 
+    walker = FixesWalker(index, do_verbose)
     if options.do_single:
-        fixes = get_fixes_single(cache, options.do_single, do_verbose)
-        if not do_verbose:
-            for c in fixes:
-                print(c)
-        return 0
-
-    fixes = get_fixes(cache, do_verbose)
+        fixes = get_fixes_single(walker, options.do_single)
+    else:
+        fixes = get_fixes(walker, get_series_commits())
     if not do_verbose:
-        for c in fixes:
-            print(c)
+        print_fixes(annotate_fixes(walker, fixes), options.do_annotate)
 
     return 0
 
@@ -1,66 +1,76 @@
 #!/bin/env python3
 import sys
 import os
-import configparser
-import git
 import subprocess
 import optparse
 import re
-
-CONFIG_DEFAULT = '~/.config/qtools/config'
-# We only look at patches committed within 10min of the target one
-DEFAULT_COMMIT_INTERVAL=600
-# we can add an option to specify branch and another to do it automatically (git branch -a --contains <sha>)
-DEFAULT_BRANCH = 'master'
-
-def write_single_patch(path, series, commit):
-    patch = "%s.patch" % commit
-    f = open("patches/%s" % patch, "w")
-    # ugh. Couldn't make commit.diff work the same way
-    formatted_patch = subprocess.check_output(["git", "-C", path, "log", "--cc", "-1", commit.hexsha])
-    # ffs
-    try:
-        f.write(formatted_patch.decode('utf-8'))
-    except:
-        f.write(formatted_patch.decode('iso8859-1'))
+import multiprocessing.pool
+from libqtools import qconfig
+from libqtools import qrepo
+from libqtools.qpatchset import list_patchsets, DEFAULT_COMMIT_INTERVAL
+
+def write_patch_file(patch, chunks):
+    f = open("patches/%s" % patch, "wb")
+    f.write(b''.join(chunks))
     f.close()
-    series.write("%s\n" % patch)
-
-# gets a list of patches in the same patchset by considering date and author
-def list_patchset(repo, branch, interval, commit):
-    author_email = commit.author.email
-    date = commit.committed_date
 
-    commit_list = []
-    commit_sha_list = []
-    found_commit = False
-    for c in repo.iter_commits(branch):
-        if c.committed_date < (date - interval):
-            # we're done looking
-            break
-        if c.committed_date < (date + interval):
-            if c.hexsha == commit.hexsha:
-                found_commit = True
-            if c.author.email == author_email:
-                commit_sha_list.append(c.hexsha)
-                commit_list.append(c)
-            else:
-                if found_commit:
-                    # we did it,
-                    break
-                # author might have changed and we didn't find the target commit
-                commit_list.clear()
-                commit_sha_list.clear()
-
-    if len(commit_list) == 0:
-        sys.stderr.write("Commit %s not found in branch %s. Specify a different repo or branch\n" % (commit, branch))
-        sys.stderr.write("Until an option is implemented to do this automatically, run 'git branch -a --contains %s'\n" % commit)
-        return []
-
-    commit_sha_list.reverse()
-    return (commit_list, commit_sha_list)
-
-def import_patches(repo, path, commit_list):
+# writes patches/<sha>.patch for every commit, with the same contents as
+# "git log --cc -1 <sha>" but reading them all from a single git log. The
+# patches are written as they come, using up to jobs threads
+def export_patches(path, shas, jobs=1):
+    # git log --stdin would show HEAD without revisions
+    if len(shas) == 0:
+        return
+    proc = subprocess.Popen(["git", "-C", path, "log", "--no-walk=unsorted", "--cc", "--stdin"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # git reads all the revisions before writing anything
+    proc.stdin.write(''.join(["%s\n" % sha for sha in shas]).encode())
+    proc.stdin.close()
+
+    pool = None
+    pending = []
+    if jobs > 1:
+        pool = multiprocessing.pool.ThreadPool(jobs)
+
+    def write(sha, chunks):
+        patch = "%s.patch" % sha
+        if pool is None:
+            write_patch_file(patch, chunks)
+        else:
+            pending.append(pool.apply_async(write_patch_file, (patch, chunks)))
+
+    n = 0
+    current = None
+    chunks = []
+    try:
+        for line in proc.stdout:
+            # only the line for the next expected commit starts a new patch
+            if n < len(shas) and line.startswith(b'commit ' + shas[n].encode()) \
+                    and line[47:48] in (b'\n', b' '):
+                if current is not None:
+                    # git separates the commits with an empty line
+                    if chunks[-1] == b'\n':
+                        chunks.pop()
+                    write(current, chunks)
+                current = shas[n]
+                chunks = []
+                n += 1
+            chunks.append(line)
+        if current is not None:
+            write(current, chunks)
+        for result in pending:
+            result.get()
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if rc != 0 or n != len(shas):
+        raise Exception("Unable to export patches from %s (git log returned %d)" % (path, rc))
+
+
+def import_patches(repo, path, commit_list, jobs=1):
     try:
         os.mkdir("patches")
     except FileExistsError:
@@ -78,23 +88,43 @@ def import_patches(repo, path, commit_list):
     except Exception as ex:
         raise("Unable to open series file: %s\n" % str(ex))
 
-    lines = series.readlines()
+    lines = set(series.readlines())
+    shas = []
     for commit in commit_list:
         patch = "%s.patch" % commit.hexsha
         if ("%s\n" % patch) in lines:
             print("Skipping %s: already in series" % patch)
             continue
-        write_single_patch(path, series, commit)
+        lines.add("%s\n" % patch)
+        shas.append(commit.hexsha)
+
+    if len(shas) == 0:
+        series.close()
+        return
+
+    # the series is only updated once all the patches are written
+    export_patches(path, shas, jobs)
+    series.write(''.join(["%s.patch\n" % sha for sha in shas]))
     series.close()
 
+# merge sha -> True if the merge doesn't change anything
+empty_merges = dict()
+
+# a merge is empty if it has the same tree as all its parents, which only
+# needs the tree ids instead of a diff against each parent
+def is_empty_merge(repo, commit):
+    if commit.hexsha not in empty_merges:
+        empty = True
+        for p in commit.parents:
+            if repo.commit(p).tree != commit.tree:
+                empty = False
+                break
+        empty_merges[commit.hexsha] = empty
+    return empty_merges[commit.hexsha]
+
 def get_commit_from_file(repo, sha):
     # first try by filename
-    try:
-        commit = repo.commit(sha)
-    except:
-        commit = None
-        pass
-
+    commit = repo.commit(sha)
     if commit:
         return commit
 
@@ -110,13 +140,10 @@ def get_commit_from_file(repo, sha):
         match = r.match(l)
         if match:
             found_sha = match.group(1)
-            try:
-                commit = repo.commit(found_sha)
+            commit = repo.commit(found_sha)
+            if commit:
                 return commit
-            except Exception as ex:
-                sys.stderr.write("Unable to find commit %s in repository\n" % found_sha)
-                pass
-                continue
+            sys.stderr.write("Unable to find commit %s in repository\n" % found_sha)
     return None
 
 def check_series(repo, branch, interval):
@@ -133,20 +160,26 @@ def check_series(repo, branch, interval):
             continue
         commit_sha_list.append(l.replace('.patch', ''))
 
-    missing_list = []
+    commits = []
     for c in commit_sha_list:
         commit = get_commit_from_file(repo, c)
         if commit is None:
             continue
+        commits.append(commit)
+    patchsets = list_patchsets(repo, branch, interval, commits)
 
-        (clist, sha_list) = list_patchset(repo, branch, interval, commit)
+    series_set = set(commit_sha_list)
+    missing_list = []
+    missing_set = set()
+    for commit in commits:
+        (clist, sha_list) = patchsets[commit.hexsha]
         if len(sha_list) == 0:
             return 1
 
         for p in sha_list:
-            if p not in commit_sha_list:
-                if p not in missing_list:
-                    missing_list.append(p)
+            if p not in series_set and p not in missing_set:
+                missing_list.append(p)
+                missing_set.add(p)
 
     if len(missing_list) > 0:
         for p in missing_list:
@@ -163,10 +196,11 @@ def main(argv):
     parser.add_option("-g", "--git", dest="git", default=None, help="Specify an alternate git repository path instead of the configuration one", metavar="GIT")
     parser.add_option("-P", "--patchset", dest="patchset", default=False, help="Import the whole patchset the specified commit belongs to", action="store_true")
     parser.add_option("-l", "--list-patchset", dest="do_list", default=False, help="Lists the commits in the same patchset as the specified commit", action="store_true")
-    parser.add_option("-b", "--branch", dest="branch", default=DEFAULT_BRANCH, help="Use branch BRANCH in the specified repository", metavar="BRANCH")
-    parser.add_option("-i", "--interval", dest="interval", default=DEFAULT_COMMIT_INTERVAL, help="Look for patchset patches within INTERVAL seconds", metavar="INTERVAL")
+    parser.add_option("-b", "--branch", dest="branch", default=qconfig.DEFAULT_BRANCH, help="Use branch BRANCH in the specified repository", metavar="BRANCH")
+    parser.add_option("-i", "--interval", dest="interval", default=DEFAULT_COMMIT_INTERVAL, type="int", help="Look for patchset patches within INTERVAL seconds", metavar="INTERVAL")
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int", help="Write the patch files using JOBS threads", metavar="JOBS")
     parser.add_option("-c", "--check", dest="check", default=False, help="Checks if current quilt series has missing patches from the patchset(s) in it", action="store_true")
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv[1:])
 
     path = options.git
     patchset = options.patchset
@@ -180,33 +214,12 @@ def main(argv):
         parser.print_usage()
         return 1
 
-    if path is None:
-        config = configparser.ConfigParser()
-        try:
-            config.read(os.path.expanduser(CONFIG_DEFAULT))
-            if 'repository' not in config:
-                sys.stderr.write("Repository section not found in the config file\n")
-                return 1
-            if 'upstream' not in config['repository']:
-                sys.stderr.write("No 'upstream' in repository section\n")
-                return 1
-            default_repo = "repo-%s" % config['repository']['upstream'];
-            if default_repo not in config:
-                sys.stderr.write("No default repository %s section exists\n" % default_repo)
-                return 1
-            if 'path' not in config[default_repo]:
-                sys.stderr.write("Repository section in the config file doesn't contain path=\n")
-                return 1
-            path = config[default_repo]['path']
-        except:
-            sys.stderr.write("Unable to read the config file, which is mandatory for now\n")
-            return 1
-
-    repo = git.Repo(path)
     try:
-        repo = git.Repo(path)
-    except:
-        sys.stderr.write("Unable to open git repo at %s\n" % path)
+        if path is None:
+            path = qconfig.get_repo_path(qconfig.load_config(), 'upstream')
+        repo = qrepo.get_repo(path)
+    except Exception as ex:
+        sys.stderr.write("%s\n" % str(ex))
         return 1
 
     if check:
@@ -227,28 +240,23 @@ def main(argv):
 
     # we have the user provided list, now gather commits objects
     for commit_sha in commit_sha_list:
-        try:
-            commit = repo.commit(commit_sha)
-            if len(commit.parents) == 2:
-                empty = True
-                for p in commit.parents:
-                    if commit.diff(p):
-                        empty = False
-                if empty:
-                    sys.stderr.write("Ignoring empty merge commit %s\n" % commit_sha)
-                    continue
-            commit_list.append(commit)
-        except Exception as ex:
+        commit = repo.commit(commit_sha)
+        if commit is None:
             sys.stderr.write("Unable to find commit %s in repository %s\n" % (commit_sha, path))
             # TODO: add a force option to ignore
             sys.exit(1)
+        if len(commit.parents) == 2 and is_empty_merge(repo, commit):
+            sys.stderr.write("Ignoring empty merge commit %s\n" % commit_sha)
+            continue
+        commit_list.append(commit)
 
     # now, if asked, add patches in the same patchset
     output_sha_list = []
     output_list = []
     if patchset or list_only:
+        patchsets = list_patchsets(repo, branch, interval, commit_list)
         for commit in commit_list:
-            (clist, sha_list) = list_patchset(repo, branch, interval, commit)
+            (clist, sha_list) = patchsets[commit.hexsha]
             for sha in sha_list:
                 if sha not in output_sha_list:
                     output_sha_list.append(sha)
@@ -272,7 +280,7 @@ def main(argv):
         return 0
 
     # applying
-    import_patches(repo, path, commit_list)
+    import_patches(repo, path, commit_list, options.jobs)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
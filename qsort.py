@@ -1,15 +1,11 @@
 #!/bin/env python3
 import sys
-import os
-import configparser
-import git
 import optparse
 import datetime
-import difflib
-
-CONFIG_DEFAULT = '~/.config/qtools/config'
-# we can add an option to specify branch and another to do it automatically (git branch -a --contains <sha>)
-DEFAULT_BRANCH = 'master'
+import re
+import subprocess
+from libqtools import qconfig
+from libqtools import qrepo
 
 def save_backup(filename, s):
     d = datetime.datetime.now()
@@ -18,47 +14,71 @@ def save_backup(filename, s):
     f.write(s.read())
     f.close()
 
+# returns the merge base of the series commits. They all descend from it, so
+# the walk can stop at its parents
+def get_boundary(path, shas):
+    if len(shas) == 1:
+        return shas
+    proc = subprocess.run(["git", "-C", path, "merge-base", "--octopus"] + shas, stdout=subprocess.PIPE)
+    if proc.returncode > 1:
+        raise Exception("Unable to find the merge base of the series commits (git merge-base returned %d)" % proc.returncode)
+    # no common history, everything needs to be walked
+    return proc.stdout.decode().split()
+
+# returns the series commits found in branch, in git rev-list --topo-order
+# order (newest first)
+def find_upstream_order(repo, branch, series_hash):
+    # only full shas of existing commits can match
+    wanted = set()
+    for c in series_hash:
+        if re.match('^[0-9a-f]{40}$', c) and repo.resolve_commit(c) == c:
+            wanted.add(c)
+    if len(wanted) == 0:
+        return []
+
+    cmd = ["git", "-C", repo.path, "rev-list", "--topo-order", branch, "--not"]
+    cmd += ["%s^@" % c for c in get_boundary(repo.path, sorted(wanted))]
+    cmd.append("--")
+    found = []
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    done = False
+    try:
+        for line in proc.stdout:
+            sha = line.decode().strip()
+            if sha in wanted:
+                found.append(sha)
+                if len(found) == len(wanted):
+                    done = True
+                    break
+    finally:
+        proc.stdout.close()
+        if done:
+            proc.kill()
+        rc = proc.wait()
+    if not done and rc != 0:
+        raise Exception("Unable to read the history of %s (git rev-list returned %d)" % (branch, rc))
+    return found
+
 def main(argv):
     usage = "usage: %prog [options]"
     parser = optparse.OptionParser(usage=usage)
     parser.add_option("-a", "--apply", dest="do_apply", default=False, help="Apply changes instead of showing differences", action="store_true")
     parser.add_option("-f", "--force", dest="force", default=False, help="Ignore commits that won't be found and list them at the end", action="store_true")
     parser.add_option("-g", "--git", dest="git", default=None, help="Specify a different git repository path instead of the one in the configuration", metavar="GIT")
-    parser.add_option("-b", "--branch", dest="branch", default=DEFAULT_BRANCH, help="Use branch BRANCH in the specified repository", metavar="BRANCH")
-    (options, args) = parser.parse_args()
+    parser.add_option("-b", "--branch", dest="branch", default=qconfig.DEFAULT_BRANCH, help="Use branch BRANCH in the specified repository", metavar="BRANCH")
+    (options, args) = parser.parse_args(argv[1:])
 
     path = options.git
     do_apply = options.do_apply
     branch = options.branch
     force = options.force
 
-    if path is None:
-        config = configparser.ConfigParser()
-        try:
-            config.read(os.path.expanduser(CONFIG_DEFAULT))
-            if 'repository' not in config:
-                sys.stderr.write("Repository section not found in the config file\n")
-                return 1
-            if 'default' not in config['repository']:
-                sys.stderr.write("No 'upstream' in repository section\n")
-                return 1
-            upstream_repo = "repo-%s" % config['repository']['upstream'];
-            if upstream_repo not in config:
-                sys.stderr.write("No upstream repository %s section exists\n" % upstream_repo)
-                return 1
-            if 'path' not in config[upstream_repo]:
-                sys.stderr.write("Repository section in the config file doesn't contain path=\n")
-                return 1
-            path = config[upstream_repo]['path']
-        except:
-            sys.stderr.write("Unable to read the config file, which is mandatory for now\n")
-            return 1
-
-    repo = git.Repo(path)
     try:
-        repo = git.Repo(path)
-    except:
-        sys.stderr.write("Unable to open git repo at %s\n" % path)
+        if path is None:
+            path = qconfig.get_repo_path(qconfig.load_config(), 'upstream')
+        repo = qrepo.get_repo(path)
+    except Exception as ex:
+        sys.stderr.write("%s\n" % str(ex))
         return 1
 
     try:
@@ -78,14 +98,11 @@ def main(argv):
         series_newline.append(l)
         series_hash.append(l.replace('.patch\n','').replace('.patch', ''))
 
-    for c in repo.iter_commits(branch):
-        if c.hexsha in series_hash:
-            found.append(c.hexsha)
-        if len(found) == len(series):
-            break
+    found = find_upstream_order(repo, branch, series_hash)
 
+    found_set = set(found)
     for c in series_hash:
-        if c not in found:
+        if c not in found_set:
             missing.append(c)
 
     if not force:
@@ -112,6 +129,7 @@ def main(argv):
                 series_file.write("%s.patch\n" % c)
     else:
         # if we're forcing, the unknown patches are added to the end
+        import difflib
         ordered = []
         for c in found + missing:
             ordered.append("%s.patch\n" % c)
@@ -0,0 +1,169 @@
+#!/bin/env python3
+# Keeps the upstream repository, the fixes index and the backport caches
+# open and answers queries from qfixes and qup over a unix socket. The tools
+# use it automatically when it's running.
+#
+# Each request is a JSON object in a single line, and so is the response:
+# {"result": ...} or {"error": "..."}. Commands:
+#   ping
+#   fixes     commits, series, branch, verbose: the fixes for each commit, or
+#             for the whole series if series is true
+#   backport  repo, commits: the backports of the upstream commits
+#   stop
+import sys
+import os
+import optparse
+import json
+import socketserver
+import warnings
+import qfixes
+import qup
+from libqtools import qclient
+from libqtools import qconfig
+from libqtools import qindex
+from libqtools import gitbatch
+warnings.filterwarnings("ignore")
+
+def file_stamp(filename):
+    try:
+        st = os.stat(filename)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = {'result': self.server.handle_command(request)}
+            except Exception as ex:
+                response = {'error': str(ex)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+# requests are handled one at a time, the git cat-file processes can't be
+# shared between threads
+class QtoolsServer(socketserver.UnixStreamServer):
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.stopping = False
+        self.config = None
+        self.config_stamp = None
+        self.resolvers = dict()
+        self.indexes = dict()
+
+    # the tools update the config file (watermarks, caches), so it's read
+    # again when it changes
+    def get_config(self):
+        stamp = file_stamp(os.path.expanduser(qconfig.CONFIG_DEFAULT))
+        if self.config is None or stamp != self.config_stamp:
+            self.config = qconfig.read_config()
+            self.config_stamp = stamp
+        return self.config
+
+    def get_resolver(self, path):
+        resolver = self.resolvers.get(path)
+        if resolver is None:
+            resolver = gitbatch.CatFileCheck(path)
+            self.resolvers[path] = resolver
+        return resolver
+
+    # indexes and their deltas are replaced, not modified, by updates
+    def get_index(self, filename, open_index, cache):
+        stamp = (file_stamp(filename), file_stamp(qindex.delta_filename(filename)))
+        cached = self.indexes.get(filename)
+        if cached is None or cached[0] != stamp:
+            if cached is not None:
+                cached[1].close()
+            cached = (stamp, open_index(cache))
+            self.indexes[filename] = cached
+        return cached[1]
+
+    def handle_command(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'ping':
+            return 'pong'
+        if cmd == 'stop':
+            self.stopping = True
+            return 'bye'
+        if cmd == 'fixes':
+            return self.get_fixes(request)
+        if cmd == 'backport':
+            return self.get_backports(request)
+        raise Exception("Unknown command %s" % cmd)
+
+    def get_fixes(self, request):
+        config = self.get_config()
+        (path, cache) = qfixes.get_fixes_config(config)
+        branch = request.get('branch', qconfig.DEFAULT_BRANCH)
+        verbose = request.get('verbose', False)
+
+        log = []
+        qfixes.check_update_state(self.get_resolver(path), branch, qfixes.get_last(config, branch), log.append)
+        index = self.get_index(qfixes.get_index_filename(cache), qfixes.open_fixes_index, cache)
+        output = []
+        if request.get('series', False):
+            walker = qfixes.FixesWalker(index, verbose, log.append)
+            fixes = qfixes.get_fixes(walker, request['commits'])
+            output.append(qfixes.annotate_fixes(walker, fixes))
+        else:
+            for c in request['commits']:
+                walker = qfixes.FixesWalker(index, verbose, log.append)
+                fixes = qfixes.get_fixes_single(walker, c)
+                output.append(qfixes.annotate_fixes(walker, fixes))
+        return {'log': log, 'fixes': output}
+
+    def get_backports(self, request):
+        config = self.get_config()
+        repo_name = request.get('repo') or qup.get_default_repo(config)
+        cache = qup.get_backport_cache(config, repo_name)
+        index = self.get_index(qup.get_index_filename(cache), qup.open_backport_index, cache)
+        resolver = self.get_resolver(qconfig.get_repo_path(config, 'upstream'))
+        return qup.get_backport_status(index, resolver, request['commits'])
+
+def main(argv):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-s", "--socket", dest="socket", default=None, help="Listen on SOCKET instead of the configured one", metavar="SOCKET")
+    parser.add_option("-k", "--stop", dest="do_stop", default=False, help="Stop a running daemon", action="store_true")
+    (options, args) = parser.parse_args(argv[1:])
+
+    config = qconfig.load_config()
+    path = options.socket
+    if path is None:
+        path = qclient.get_socket_path(config)
+
+    if options.do_stop:
+        if qclient.query(config, {'cmd': 'stop'}, path) is None:
+            sys.stderr.write("qtoolsd is not running on %s\n" % path)
+            return 1
+        return 0
+
+    if os.path.exists(path):
+        if qclient.query(config, {'cmd': 'ping'}, path) is not None:
+            sys.stderr.write("qtoolsd is already running on %s\n" % path)
+            return 1
+        # left behind by a daemon that was killed
+        os.unlink(path)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mask = os.umask(0o077)
+    try:
+        server = QtoolsServer(path)
+    finally:
+        os.umask(mask)
+
+    try:
+        while not server.stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
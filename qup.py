@@ -1,126 +1,229 @@
 #!/bin/env python3
 import sys
 import os
-import configparser
-import git
 import optparse
-import datetime
-import difflib
 import errno
 import re
+import subprocess
+import shutil
+import umatch
 import warnings
+from libqtools import qclient
+from libqtools import qindex
+from libqtools import gitbatch
+from libqtools import qconfig
+from libqtools import qrepo
 warnings.filterwarnings("ignore")
 
-CONFIG_DEFAULT = '~/.config/qtools/config'
-DEFAULT_BRANCH = 'master'
 DEFAULT_CACHE_DIR= '~/.qtools/backport'
-TEMP_REMOTE = "qtools_upstream"
+BACKPORT_INDEX = 'backports.idx'
+# directories used by the old one file per backport cache
+OLD_CACHE_DIRS = ['0','1','2','3','4','5','6','7','8','9', 'a','b','c','d','e','f']
+
+# git reads the upstream objects directly, as an extra alternate, so
+# nothing needs to be fetched into the downstream repository
+def compute_merge_base(path, tip, upstream, upstream_tip):
+    objects = subprocess.check_output(["git", "-C", upstream, "rev-parse", "--git-path", "objects"]).decode().strip()
+    alternates = os.path.abspath(os.path.join(upstream, objects))
+    env = dict(os.environ)
+    if 'GIT_ALTERNATE_OBJECT_DIRECTORIES' in env:
+        alternates = "%s%s%s" % (alternates, os.pathsep, env['GIT_ALTERNATE_OBJECT_DIRECTORIES'])
+    env['GIT_ALTERNATE_OBJECT_DIRECTORIES'] = alternates
 
-def create_backport_cache(path):
-    for c in string.digits + string.ascii_lowercase[:6]:
-        try:
-            os.mkdir("%s/%s" % (path, c))
-        except OSError as error:
-            if error.errno != errno.EEXIST:
-                raise(error)
-
-def create_temp_remote(repo, upstream):
-    remove_temp_remote(repo)
-    remote = repo.create_remote(TEMP_REMOTE, upstream)
-    remote.fetch()
-
-def remove_temp_remote(repo):
     try:
-        repo.delete_remote(TEMP_REMOTE)
-    except:
-        pass
-
-def update_backport_cache(repo, cache, branch, upstream):
+        output = subprocess.check_output(["git", "-C", path, "merge-base", tip, upstream_tip], env=env)
+    except subprocess.CalledProcessError:
+        raise Exception("Unable to find a merge base between %s and upstream %s" % (tip, upstream_tip))
+    return output.decode().strip()
+
+# the last merge base is kept as "<tip> <upstream tip> <merge base>"
+def get_merge_base(path, state, tip, upstream, upstream_branch):
+    upstream_tip = subprocess.check_output(["git", "-C", upstream, "rev-parse", "%s^{commit}" % upstream_branch]).decode().strip()
+    if 'merge-base' in state:
+        cached = state['merge-base'].split()
+        if len(cached) == 3 and cached[0] == tip and cached[1] == upstream_tip:
+            return cached[2]
+
+    merge_base = compute_merge_base(path, tip, upstream, upstream_tip)
+    state['merge-base'] = "%s %s %s" % (tip, upstream_tip, merge_base)
+    return merge_base
+
+def get_message(c):
+    msg = c.message
+    if type(msg) is bytes:
+        try:
+            msg = msg.decode('utf-8', errors='ignore')
+        except Exception as error:
+            msg = msg.decode('iso8859-1', errors='ignore')
+    return msg
+
+# returns the upstream commit a downstream commit is a backport of, if any
+def get_upstream_commit(msg):
+    while True:
+        match = re.findall('^[\ ]*commit\ ([0-9a-f]+)$', msg, re.MULTILINE)
+        if match:
+            break
+        match = re.findall('^[\ ]*\(cherry\ picked\ from\ commit\ ([0-9a-f]+)\)$', msg, re.MULTILINE)
+        if match:
+            break
+        match = re.findall('^[\ ]*[uU]pstream\ [sS]tatus:\ [rR][hH][eE][lL].*', msg, re.MULTILINE)
+        if match:
+            match = None
+            break
+        match = re.findall('\[redhat\]\ kernel-.*', msg, re.MULTILINE)
+        if not match:
+            #sys.stderr.write("Unable to find upstream commit in commit %s\n" % c.hexsha)
+            match = None
+        break
+
+    if match is None:
+        return None
+    return match[0]
+
+# "[redhat] kernel-" commits and abbreviated shas can't be indexed
+def get_upstream_binsha(c):
+    upstream = get_upstream_commit(get_message(c))
+    if upstream is None or not re.match('^[0-9a-f]{40}$', upstream):
+        return None
+    return bytes.fromhex(upstream)
+
+def get_index_filename(cache):
+    return "%s/%s" % (cache, BACKPORT_INDEX)
+
+# returns (upstream -> downstream commits, downstream -> upstream commit,
+# umatch patch hash -> downstream commits) and if the index has patch hashes
+def read_backport_tables(cache):
+    index = qindex.PackedIndex(get_index_filename(cache))
+    tables = (index.to_dict(0), index.to_dict(1), index.to_dict(2))
+    has_hashes = index.table_count() > 2
+    index.close()
+    return (tables, has_hashes)
+
+def write_backport_tables(cache, tables):
+    qindex.write_index(get_index_filename(cache), tables[0], tables[1], tables[2])
+
+def add_hashes(tables, path, revs):
+    for (sha, patch_hash) in umatch.hash_commits(path, revs):
+        if patch_hash is None:
+            continue
+        downstream = tables[2].setdefault(bytes.fromhex(patch_hash), [])
+        c = bytes.fromhex(sha)
+        if c not in downstream:
+            downstream.append(c)
+
+def remove_hashes(tables, commits):
+    for patch_hash in list(tables[2]):
+        downstream = [c for c in tables[2][patch_hash] if c not in commits]
+        if len(downstream) == 0:
+            del tables[2][patch_hash]
+        else:
+            tables[2][patch_hash] = downstream
+
+# new backports of the same upstream commit go first
+def add_backports(tables, added):
+    for upstream, downstream in added.items():
+        current = tables[0].get(upstream, [])
+        tables[0][upstream] = downstream + [c for c in current if c not in downstream]
+        for c in downstream:
+            tables[1][c] = [upstream]
+
+# used for commits that are gone after a rebase
+def remove_backport(tables, c):
+    for upstream in tables[1].pop(c, []):
+        downstream = tables[0].get(upstream, [])
+        if c in downstream:
+            downstream.remove(c)
+        if len(downstream) == 0:
+            tables[0].pop(upstream, None)
+
+# converts the old <cache>/<first hex>/<upstream sha> files into the index
+def migrate_cache(cache):
+    dirs = []
+    for c in OLD_CACHE_DIRS:
+        directory = "%s/%s" % (cache, c)
+        if os.path.isdir(directory):
+            dirs.append(directory)
+    if len(dirs) == 0:
+        return
+
+    sys.stderr.write("Migrating backport cache in %s to %s\n" % (cache, BACKPORT_INDEX))
+    added = dict()
+    for directory in dirs:
+        for name in os.listdir(directory):
+            f = open("%s/%s" % (directory, name), "r")
+            backport = f.read().strip()
+            f.close()
+            if re.match('^[0-9a-f]{40}$', name) and re.match('^[0-9a-f]{40}$', backport):
+                added[bytes.fromhex(name)] = [bytes.fromhex(backport)]
+
+    (tables, has_hashes) = read_backport_tables(cache)
+    add_backports(tables, added)
+    write_backport_tables(cache, tables)
+    for directory in dirs:
+        shutil.rmtree(directory)
+
+def open_backport_index(cache):
+    migrate_cache(cache)
+    return qindex.PackedIndex(get_index_filename(cache))
+
+# only commits after the last scanned one (last= in the repository section,
+# state) are scanned. If the branch was rebased or force-pushed, the commits
+# that are gone are removed from the cache and the new ones scanned
+def update_backport_cache(repo, path, cache, branch, upstream, upstream_branch, state):
     try:
         os.mkdir(cache)
     except OSError as error:
         if error.errno != errno.EEXIST:
             raise(error)
-
-    create_temp_remote(repo, upstream)
-
-    # FIXME - make upstream's branch configurable
-    merge_base = repo.merge_base(branch, "%s/%s" % (TEMP_REMOTE, 'master'))[0]
-
-    for c in repo.iter_commits(branch):
-        if c == merge_base:
-            break
-
+    migrate_cache(cache)
+
+    tip = repo.resolve_commit(branch)
+    if tip is None:
+        raise Exception("Unable to find %s in %s" % (branch, path))
+    merge_base = get_merge_base(path, state, tip, upstream, upstream_branch)
+    (tables, has_hashes) = read_backport_tables(cache)
+
+    revs = [tip, "^%s" % merge_base]
+    last = None
+    if 'last' in state:
+        last = state['last']
+    if last:
+        found = repo.resolve_commit(last)
+        if found is None:
+            sys.stderr.write("Last scanned commit %s not found, rescanning %s\n" % (last, branch))
+        last = found
+    if last:
+        if not repo.is_ancestor(last, tip):
+            sys.stderr.write("%s was rewritten since the last update, rescanning the changed commits\n" % branch)
+            dropped = set()
+            for c in repo.iter_commits([last, "^%s" % tip, "^%s" % merge_base]):
+                remove_backport(tables, c.binsha)
+                dropped.add(c.binsha)
+            remove_hashes(tables, dropped)
+        revs.append("^%s" % last)
+
+    added = dict()
+    for c in repo.iter_commits(revs):
         if len(c.parents) > 1:
             #sys.stderr.write("Ignoring merge %s\n" % c.hexsha)
             continue
+        upstream_sha = get_upstream_binsha(c)
+        if upstream_sha is not None:
+            added.setdefault(upstream_sha, []).append(c.binsha)
 
-        msg = c.message
-        if type(msg) is bytes:
-            try:
-                msg = msg.decode('utf-8', errors='ignore')
-            except Exception as error:
-                msg = None
-                pass
-            if msg is None:
-                msg = msg.decode('iso8859-1', errors='ignore')
-
-        while True:
-            match = re.findall('^[\ ]*commit\ ([0-9a-f]+)$', msg, re.MULTILINE)
-            if match:
-                break
-            match = re.findall('^[\ ]*\(cherry\ picked\ from\ commit\ ([0-9a-f]+)\)$', msg, re.MULTILINE)
-            if match:
-                break
-            match = re.findall('^[\ ]*[uU]pstream\ [sS]tatus:\ [rR][hH][eE][lL].*', msg, re.MULTILINE)
-            if match:
-                match = None
-                break
-            match = re.findall('\[redhat\]\ kernel-.*', msg, re.MULTILINE)
-            if not match:
-                #sys.stderr.write("Unable to find upstream commit in commit %s\n" % c.hexsha)
-                match = None
-            break
-
-        if match is None:
-            continue
-
-        upstream = match[0]
-        backport = c.hexsha
-
-        directory = os.path.expanduser("%s/%s" % (cache, upstream[0]))
-        os.makedirs(directory, exist_ok = True)
-
-        filename = "%s/%s" % (directory, upstream)
-        f = open(filename, "w")
-        f.write("%s" % backport)
-        f.close()
-
-    remove_temp_remote(repo)
+    add_backports(tables, added)
+    if has_hashes:
+        add_hashes(tables, path, revs)
+    else:
+        # the cache is from before patch hashes were kept, hash everything
+        add_hashes(tables, path, [tip, "^%s" % merge_base])
+    write_backport_tables(cache, tables)
+    state['last'] = tip
 
 def get_default_repo(config):
-    repo = ''
-    if 'repository' not in config:
-        raise Exception("Repository section not found in the config file")
-    if 'default' not in config['repository']:
-        raise Exception("No 'default' in repository section")
-    default_repo = "repo-%s" % config['repository']['default'];
-    if default_repo not in config:
-        raise Exception("No default repository %s section exists" % default_repo)
-    return default_repo
-
-def get_repo_path(config, repo):
-        if 'path' not in config[repo]:
-            raise Exception("Repository section in the config file doesn't contain path=")
-        return config[repo]['path']
-
-def get_repo_branch(config, repo):
-        if 'branch' not in config[repo]:
-            sys.stdout.write("Repository section in the config file doesn't contain branch, using 'master'\n")
-            return 'master';
-        return config[repo]['branch']
-
-def get_backport_cache(config, filename, repo):
+    return qconfig.get_repo_section(config, 'default')
+
+def get_backport_cache(config, repo):
         if 'cache' not in config[repo]:
             # FIXME - make default_cache_dir configurable
             directory = os.path.expanduser("%s/%s" % (DEFAULT_CACHE_DIR, repo))
@@ -130,31 +233,98 @@ def get_backport_cache(config, filename, repo):
                 if error.errno != errno.EEXIST:
                     raise(error)
 
-            f = open(os.path.expanduser(filename), "w")
             config[repo]['cache'] = directory
-            config.write(f)
-            f.close()
+            qconfig.write_config(config)
 
             return directory
         return os.path.expanduser(config[repo]['cache'])
 
-def get_upstream(config, repo):
-        if 'upstream' not in config['repository']:
-            raise Exception("Repository section doesn't have upstream=")
-        name = config['repository']['upstream']
-        return config['repo-%s' % name]['path']
-
-def check_backport(cache, sha, verbose):
+def lookup(index, sha, table):
     try:
-        f = open("%s/%s/%s" % (cache, sha[0], sha))
-        if verbose:
-            print("%s" % f.read())
-        f.close()
-        return 0
-    except:
+        key = bytes.fromhex(sha)
+    except ValueError:
+        return []
+    return [c.hex() for c in index.lookup(key, table)]
+
+# returns every backport of an upstream commit, newest first
+def get_backports(index, sha):
+    return lookup(index, sha, 0)
+
+# returns the upstream commit of a backport, if known
+def get_upstream_of(index, sha):
+    found = lookup(index, sha, 1)
+    if len(found) == 0:
+        return None
+    return found[0]
+
+def check_backport(index, sha, verbose):
+    backports = get_backports(index, sha)
+    if len(backports) == 0:
         return 1
+    if verbose:
+        for c in backports:
+            print(c)
+    return 0
+
+# returns a {commit, backports} or {commit, error} dictionary for each sha.
+# resolver is a gitbatch.CatFileCheck on the upstream repository
+def get_backport_status(index, resolver, shas):
+    output = []
+    for sha in shas:
+        # expands shortened shas and catches anything that isn't an upstream
+        # commit, the resolver is already open so it's cheap
+        found = resolver.resolve_commit(sha)
+        if found is None:
+            output.append({'commit': sha, 'error': "Unable to find commit %s upstream" % sha})
+            continue
+        sha = found
+        output.append({'commit': sha, 'backports': get_backports(index, sha)})
+    return output
+
+# reads one sha per line, the first word of each line is used so the output
+# of qfixes can be used directly
+def read_shas(f):
+    output = []
+    for l in f.readlines():
+        l = l.strip()
+        if len(l) == 0 or l[0] == '#':
+            continue
+        output.append(l.split()[0])
+    return output
+
+def check_backports(config, repo_name, cache, upstream, shas, batch):
+    status = qclient.query(config, {'cmd': 'backport', 'repo': repo_name, 'commits': shas})
+    if status is None:
+        resolver = gitbatch.CatFileCheck(upstream)
+        status = get_backport_status(open_backport_index(cache), resolver, shas)
+        resolver.close()
+
+    ret = 0
+    for s in status:
+        if not batch:
+            if 'error' in s:
+                raise Exception(s['error'])
+            for c in s['backports']:
+                print(c)
+        elif 'error' in s:
+            print("%s unknown" % s['commit'])
+        elif len(s['backports']) > 0:
+            print("%s backported-as %s" % (s['commit'], ' '.join(s['backports'])))
+        else:
+            print("%s missing" % s['commit'])
 
-def quilt_prune(cache):
+        if 'error' in s or len(s['backports']) == 0:
+            ret = 1
+    return ret
+
+# returns the downstream commits with the same changes as a patch file
+def find_by_content(index, filename):
+    patch_hash = umatch.hash_file(filename)
+    if patch_hash is None:
+        return []
+    return [c.hex() for c in index.lookup(bytes.fromhex(patch_hash), 2)]
+
+def quilt_prune(index):
     f = open("patches/series")
     patches = f.readlines()
     f.close()
@@ -165,11 +335,17 @@ def quilt_prune(cache):
             continue
         if p[0] == '#':
             continue
-        commit = p.split('.')[0]
-        if check_backport(cache, commit, False) == 1:
-            output.append("%s.patch" % commit)
-        else:
+        name = p.split()[0]
+        commit = name.split('.')[0]
+        if check_backport(index, commit, False) == 0:
             changed = True
+            continue
+        found = find_by_content(index, "patches/%s" % name)
+        if len(found) > 0:
+            sys.stderr.write("%s has the same changes as %s\n" % (name, found[0]))
+            changed = True
+            continue
+        output.append(p.rstrip('\n'))
 
     if changed:
         f = open("patches/series", "w")
@@ -179,52 +355,54 @@ def quilt_prune(cache):
     return 0
 
 def main(argv):
-    config = configparser.ConfigParser()
-    config.read(os.path.expanduser(CONFIG_DEFAULT))
+    config = qconfig.load_config()
     default_repo = get_default_repo(config)
     repo_name = default_repo
 
     usage = "usage: %prog [options]"
     parser = optparse.OptionParser(usage=usage)
     parser.add_option("-u", "--update", dest="do_update", help="Update cache for the given tree", action="store_true", default=False)
-    parser.add_option("-c", "--check", dest="do_check", help="Check if a commit was backported in the current project", default=None, metavar="sha")
+    parser.add_option("-c", "--check", dest="do_check", help="Check if a commit was backported in the current project. With -, check every sha read from the standard input", default=None, metavar="sha")
+    parser.add_option("-d", "--downstream", dest="downstream", help="Show the upstream commit a downstream commit is a backport of", default=None, metavar="sha")
     parser.add_option("-r", "--repo", dest="repo", help="Specify which repo to use instead of default", default=None)
     parser.add_option("-q", "--quilt-prune", dest="quilt", help="Remove commits from the quilt series that are already backported", action="store_true", default=False)
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv[1:])
 
     if options.repo is None:
-        print("Repository not specified, using default (%s)" % default_repo.replace('repo-', ''))
+        sys.stderr.write("Repository not specified, using default (%s)\n" % default_repo.replace('repo-', ''))
     else:
         repo_name = "repo-%s" % options.repo
 
-    branch = get_repo_branch(config, repo_name)
-    upstream = get_upstream(config, repo_name)
-    path = get_repo_path(config, repo_name)
-    cache = get_backport_cache(config, CONFIG_DEFAULT, repo_name)
-
-    try:
-        repo = git.Repo(path)
-    except:
-        sys.stderr.write("Unable to open git repo at %s\n" % path)
-        return 1
+    upstream = qconfig.get_repo_path(config, 'upstream')
+    path = qconfig.get_section_path(config, repo_name)
+    cache = get_backport_cache(config, repo_name)
 
+    if options.do_check == '-':
+        return check_backports(config, repo_name, cache, upstream, read_shas(sys.stdin), True)
     if options.do_check is not None:
-        sha = options.do_check
-        if len(sha) < 40:
-            # expand a shortened sha
-            try:
-                repo2 = git.Repo(upstream)
-                c = repo2.commit(sha)
-                sha = c.hexsha
-            except:
-                raise Exception("Unable to find commit %s upstream" % sha)
-        return check_backport(cache, sha, True)
+        return check_backports(config, repo_name, cache, upstream, [options.do_check], False)
+
+    if options.downstream is not None:
+        sha = qrepo.get_repo(path).resolve_commit(options.downstream)
+        if sha is None:
+            raise Exception("Unable to find commit %s in %s" % (options.downstream, path))
+        upstream_sha = get_upstream_of(open_backport_index(cache), sha)
+        if upstream_sha is None:
+            return 1
+        print(upstream_sha)
+        return 0
 
     if options.do_update:
-        return update_backport_cache(repo, cache, branch, upstream)
+        # only the update walks the downstream branch
+        if 'branch' not in config[repo_name]:
+            sys.stderr.write("Repository section in the config file doesn't contain branch, using '%s'\n" % qconfig.DEFAULT_BRANCH)
+        branch = qconfig.get_section_branch(config, repo_name)
+        update_backport_cache(qrepo.get_repo(path), path, cache, branch, upstream, qconfig.get_repo_branch(config, 'upstream'), config[repo_name])
+        qconfig.write_config(config)
+        return 0
 
     if options.quilt:
-        return quilt_prune(cache)
+        return quilt_prune(open_backport_index(cache))
 
     parser.print_help()
 
@@ -1,99 +1,148 @@
 #!/usr/bin/python3
 
 import sys
-import string
+import os
+import stat
 import hashlib
 import re
-
-_hunk_re = re.compile('^\@\@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? \@\@')
-_filename_re = re.compile('^(---|\+\+\+) (\S+)')
-
-def parse_patch(text):
-    patchbuf = ''
-    commentbuf = ''
-    buf = ''
-
-    # state specified the line we just saw, and what to expect next
-    state = 0
-    # 0: text
-    # 1: suspected patch header (diff, ====, Index:)
-    # 2: patch header line 1 (---)
-    # 3: patch header line 2 (+++)
-    # 4: patch hunk header line (@@ line)
-    # 5: patch hunk content
-    # 6: git diff rename extented header lines (similarity 100%)
-    #
-    # valid transitions:
-    #  0 -> 1 (diff, ===, Index:)
-    #  0 -> 2 (---)
-    #  1 -> 2 (---)
-    #  1 -> 6 (similarity index 100%)
-    #  2 -> 3 (+++)
-    #  3 -> 4 (@@ line)
-    #  4 -> 5 (patch content)
-    #  5 -> 1 (run out of lines from @@-specifed count)
-    #  6 -> 0 (git rename headers processed, handle next diff if presented)
-    #
-    # Suspected patch header is stored into buf, and appended to
-    # patchbuf if we find a following hunk. Otherwise, append to
-    # comment after parsing.
-
-    # line counts while parsing a patch hunk
-    lc = (0, 0)
-    hunk = 0
-    patchline = []
-    commentline = []
-
-    for line in text.split('\n'):
-        line += '\n'
+import optparse
+import collections
+import functools
+import dbm
+import json
+import subprocess
+import multiprocessing
+from libqtools import qindex
+from libqtools import gitbatch
+from libqtools import qconfig
+from libqtools.qseries import read_series
+
+DEFAULT_CACHE_DIR = '~/.qtools/umatch'
+UPSTREAM_INDEX = 'upstream.idx'
+FINGERPRINT_CACHE = 'fingerprints'
+HUNK_HASH_SIZE = 8
+# the index is always built with the default hash
+DEFAULT_HASH = 'sha512'
+HASH_ALGORITHMS = ['sha512', 'blake2b']
+
+_hunk_re = re.compile(rb'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+_filename_re = re.compile(rb'^(---|\+\+\+) (\S+)')
+_commit_re = re.compile(rb'^commit ([a-f0-9]{40})')
+_cherry_pick_re = re.compile(rb'^.*cherry picked from commit ([a-f0-9]{40})')
+_rhel_only_re = re.compile(rb'^[uU]pstream.[sS]tatus:.[rR][hH][eE][lL]-[oO]nly')
+
+# Patches are parsed and hashed as bytes, one line at a time, so the memory
+# used doesn't depend on the size of the patch. parse_patch() and hash_patch()
+# still accept str for the callers that already have the whole text.
+class PatchParser:
+    def __init__(self, patch=None, comment=None):
+        # called with each piece of patch or comment text, made of full lines
+        self.patch = patch
+        self.comment = comment
+        self.buf = b''
+
+        # state specified the line we just saw, and what to expect next
+        self.state = 0
+        # 0: text
+        # 1: suspected patch header (diff, ====, Index:)
+        # 2: patch header line 1 (---)
+        # 3: patch header line 2 (+++)
+        # 4: patch hunk header line (@@ line)
+        # 5: patch hunk content
+        # 6: git diff rename extented header lines (similarity 100%)
+        #
+        # valid transitions:
+        #  0 -> 1 (diff, ===, Index:)
+        #  0 -> 2 (---)
+        #  1 -> 2 (---)
+        #  1 -> 6 (similarity index 100%)
+        #  2 -> 3 (+++)
+        #  3 -> 4 (@@ line)
+        #  4 -> 5 (patch content)
+        #  5 -> 1 (run out of lines from @@-specifed count)
+        #  6 -> 0 (git rename headers processed, handle next diff if presented)
+        #
+        # Suspected patch header is stored into buf, and passed on as
+        # patch if we find a following hunk. Otherwise, as comment.
+
+        # line counts while parsing a patch hunk
+        self.lc = [0, 0]
+        self.hunk = 0
+        # splitting text on '\n' gives an extra empty line when it ends
+        # with a newline, keep doing the same
+        self.newline = True
+
+    def _patch(self, data):
+        if self.patch is not None and len(data) > 0:
+            self.patch(data)
+
+    def _comment(self, data):
+        if self.comment is not None and len(data) > 0:
+            self.comment(data)
+
+    def feed(self, line):
+        self.newline = line.endswith(b'\n')
+        if not self.newline:
+            line += b'\n'
+        self._parse(line)
+
+    def close(self):
+        if self.newline:
+            self._parse(b'\n')
+            self.newline = False
+        self._comment(self.buf)
+        self.buf = b''
+
+    def _parse(self, line):
+        state = self.state
 
         if state == 0:
-            if line.startswith('diff ') or line.startswith('===') \
-                    or line.startswith('Index: '):
+            if line.startswith(b'diff ') or line.startswith(b'===') \
+                    or line.startswith(b'Index: '):
                 state = 1
-                buf += line
+                self.buf += line
 
-            elif line.startswith('--- '):
+            elif line.startswith(b'--- '):
                 state = 2
-                buf += line
+                self.buf += line
 
             else:
-                commentline.append(line)
+                self._comment(line)
 
         elif state == 1:
-            buf += line
-            if line.startswith('--- '):
+            self.buf += line
+            if line.startswith(b'--- '):
                 state = 2
             # This is for pure rename(similarity 100%).
             # Similarity less than 100% has hunk following the rename headers
             # and can be handled in state 1.
-            elif line.startswith('similarity index 100%'):
+            elif line.startswith(b'similarity index 100%'):
                 state = 6
-            elif line.startswith('diff ') or line.startswith('Index: ') \
-                     or line.startswith('deleted file ') \
-                     or line.startswith('new file ') or line.startswith('====') \
-                     or line.startswith('RCS file: ') or line.startswith('retrieving revision ') \
-                     or line.startswith('similarity index ') or line.startswith('rename from ') \
-                     or line.startswith('rename to '):
+            elif line.startswith(b'diff ') or line.startswith(b'Index: ') \
+                     or line.startswith(b'deleted file ') \
+                     or line.startswith(b'new file ') or line.startswith(b'====') \
+                     or line.startswith(b'RCS file: ') or line.startswith(b'retrieving revision ') \
+                     or line.startswith(b'similarity index ') or line.startswith(b'rename from ') \
+                     or line.startswith(b'rename to '):
                 state = 1
             else:
                 state = 0
-                commentline.append(buf)
-                buf= ''
+                self._comment(self.buf)
+                self.buf = b''
 
         elif state == 2:
-            if line.startswith('+++ '):
+            if line.startswith(b'+++ '):
                 state = 3
-                buf += line
+                self.buf += line
 
-            elif hunk:
+            elif self.hunk:
                 state = 1
-                buf += line
+                self.buf += line
 
             else:
                 state = 0
-                commentline.append(buf + line)
-                buf = ''
+                self._comment(self.buf + line)
+                self.buf = b''
 
         elif state == 3:
             match = _hunk_re.match(line)
@@ -104,148 +153,699 @@ def parse_patch(text):
                         return 1
                     return int(x)
 
-                lc = list(map(fn, match.groups()))
+                self.lc = list(map(fn, match.groups()))
 
                 state = 4
-                patchline.append(buf + line)
-                buf = ''
+                self._patch(self.buf + line)
+                self.buf = b''
 
-            elif line.startswith('--- '):
-                patchline.append(buf + line)
-                buf = ''
+            elif line.startswith(b'--- '):
+                self._patch(self.buf + line)
+                self.buf = b''
                 state = 2
 
-            elif hunk:
+            elif self.hunk:
                 state = 1
-                buf += line
+                self.buf += line
 
             else:
                 state = 0
-                commentline.append(buf + line)
-                buf = ''
+                self._comment(self.buf + line)
+                self.buf = b''
 
         elif state == 4 or state == 5:
-            if line.startswith('-'):
+            lc = self.lc
+            if line.startswith(b'-'):
                 lc[0] -= 1
-            elif line.startswith('+'):
+            elif line.startswith(b'+'):
                 lc[1] -= 1
-            elif line.startswith('\ No newline at end of file'):
+            elif line.startswith(b'\\ No newline at end of file'):
                 # Special case: Not included as part of the hunk's line count
                 pass
-            elif line.startswith(' ') or line.startswith('\n') or line.startswith('\t'):
+            elif line.startswith(b' ') or line.startswith(b'\n') or line.startswith(b'\t'):
                 # only consider part of the chunk count if it starts with a
                 # valid character. this is done to catch line wraps in patch
                 # submissions
                 lc[0] -= 1
                 lc[1] -= 1
 
-            patchline.append(line)
+            self._patch(line)
 
             if lc[0] <= 0 and lc[1] <= 0:
                 state = 3
-                hunk += 1
+                self.hunk += 1
             else:
                 state = 5
 
         elif state == 6:
-            buf += line
-            if line.startswith('rename from '):
+            self.buf += line
+            if line.startswith(b'rename from '):
                 state = 6
-            elif line.startswith('rename to '):
-                patchline.append(buf)
-                buf = ''
+            elif line.startswith(b'rename to '):
+                self._patch(self.buf)
+                self.buf = b''
                 state = 0
             else:
-                commentline.append(buf)
-                buf = ''
+                self._comment(self.buf)
+                self.buf = b''
                 state = 0
 
         else:
             raise Exception("Unknown state %d! (line '%s')" % (state, line))
 
-    commentline.append(buf)
+        self.state = state
 
-    patchbuf = "".join(patchline)
-    commentbuf = "".join(commentline)
+def _split_lines(text):
+    lines = text.split(b'\n')
+    for line in lines[:-1]:
+        yield line + b'\n'
+    if len(lines[-1]) > 0:
+        yield lines[-1]
+
+def parse_patch(text):
+    is_str = isinstance(text, str)
+    if is_str:
+        text = text.encode('utf-8', errors='surrogateescape')
 
-    if patchbuf == '':
+    patchline = []
+    commentline = []
+    parser = PatchParser(patchline.append, commentline.append)
+    for line in _split_lines(text):
+        parser.feed(line)
+    parser.close()
+
+    patchbuf = b"".join(patchline)
+    commentbuf = b"".join(commentline)
+    if is_str:
+        patchbuf = patchbuf.decode('utf-8', errors='surrogateescape')
+        commentbuf = commentbuf.decode('utf-8', errors='surrogateescape')
+
+    if len(patchbuf) == 0:
         patchbuf = None
 
-    if commentbuf == '':
+    if len(commentbuf) == 0:
         commentbuf = None
 
     return (patchbuf, commentbuf)
 
-def hash_patch(str):
-    # normalise spaces
-    if str is None:
-        str = ''
-    else:
-        str = str.replace('\r', '')
-        str = str.strip() + '\n'
-
-    prefixes = ['-', '+', ' ']
-    hash = hashlib.sha512()
-
-    for line in str.split('\n'):
-
+# Hashes the normalised patch text fed to it in pieces. The whole patch is
+# never kept around: leading whitespace is dropped until the first non blank
+# line, and blank lines are held back until we know they're not at the end,
+# which gives the same result as stripping the whole text first.
+#
+# Each hunk and each file also get a short fingerprint of their own, so two
+# patches that don't match can still be compared hunk by hunk. Hunk
+# fingerprints include the file names but not the line numbers.
+class PatchHash:
+    def __init__(self, algorithm=DEFAULT_HASH):
+        self.hash = hashlib.new(algorithm)
+        self.partial = b''
+        self.started = False
+        self.last = None
+        self.blank = []
+
+        # (file name, hunk header, fingerprint)
+        self.hunks = []
+        # (file name, fingerprint)
+        self.files = []
+        self.filename = None
+        self.file_header = b''
+        self.file_hash = None
+        self.hunk_header = None
+        self.hunk_hash = None
+
+    def update(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8', errors='surrogateescape')
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def _line(self, line):
+        # normalise spaces
+        line = line.replace(b'\r', b'')
+        if not self.started:
+            line = line.lstrip()
+            if len(line) == 0:
+                return
+            self.started = True
+
+        if len(line.strip()) == 0:
+            self.blank.append(line)
+            return
+
+        if self.last is not None:
+            self._hash_line(self.last)
+        for l in self.blank:
+            self._hash_line(l)
+        self.blank = []
+        self.last = line
+
+    def _hash_line(self, line):
         if len(line) <= 0:
-            continue
+            return
 
         hunk_match = _hunk_re.match(line)
         filename_match = _filename_re.match(line)
 
         if filename_match:
             # normalise -p1 top-directories
-            if filename_match.group(1) == '---':
-                filename = 'a/'
+            if filename_match.group(1) == b'---':
+                filename = b'a/'
             else:
-                filename = 'b/'
-            filename += '/'.join(filename_match.group(2).split('/')[1:])
+                filename = b'b/'
+            filename += b'/'.join(filename_match.group(2).split(b'/')[1:])
+
+            line = filename_match.group(1) + b' ' + filename
 
-            line = filename_match.group(1) + ' ' + filename
+            if filename_match.group(1) == b'---':
+                self._end_file()
+                self.file_header = b''
+                self.file_hash = hashlib.blake2b(digest_size=HUNK_HASH_SIZE)
+            # new and deleted files are named after the side that exists
+            if self.filename is None or filename_match.group(2) != b'/dev/null':
+                self.filename = filename[2:]
+            self.file_header += line + b'\n'
 
         elif hunk_match:
+            self._end_hunk()
+            self.hunk_header = line.rstrip()
+            self.hunk_hash = hashlib.blake2b(self.file_header, digest_size=HUNK_HASH_SIZE)
+
             # remove line numbers, but leave line counts
             def fn(x):
                 if not x:
                     return 1
                 return int(x)
             line_nos = list(map(fn, hunk_match.groups()))
-            line = '@@ -%d +%d @@' % tuple(line_nos)
+            line = b'@@ -%d +%d @@' % tuple(line_nos)
 
-        elif line[0] in prefixes:
+        elif line[:1] in (b'-', b'+', b' '):
             # if we have a +, - or context line, leave as-is
             pass
 
         else:
             # other lines are ignored
-            continue
+            return
+
+        if self.hunk_hash is not None:
+            self.hunk_hash.update(line + b'\n')
+        if self.file_hash is not None:
+            self.file_hash.update(line + b'\n')
+        self.hash.update(line + b'\n')
+
+    def _name(self, name):
+        if name is None:
+            return '-'
+        return name.decode('utf-8', errors='replace')
+
+    def _end_hunk(self):
+        if self.hunk_hash is not None:
+            self.hunks.append((self._name(self.filename), self._name(self.hunk_header), self.hunk_hash.digest()))
+            self.hunk_hash = None
+
+    def _end_file(self):
+        self._end_hunk()
+        if self.file_hash is not None:
+            self.files.append((self._name(self.filename), self.file_hash.digest()))
+            self.file_hash = None
+        self.filename = None
+
+    # trailing blank lines are dropped and the last line is stripped
+    def hexdigest(self):
+        if len(self.partial) > 0:
+            self._line(self.partial)
+            self.partial = b''
+        if self.last is not None:
+            self._hash_line(self.last.rstrip())
+            self.last = None
+        self.blank = []
+        self._end_file()
+        return self.hash.hexdigest()
+
+def hash_patch(patch):
+    hash = PatchHash()
+    if patch is not None:
+        hash.update(patch)
+    return hash.hexdigest()
 
-#        hash.update(line.encode('utf-8') + '\n')
-        hash.update((line + '\n').encode('utf-8'))
+# parses and hashes a patch given one line at a time
+class PatchHasher:
+    def __init__(self, algorithm=DEFAULT_HASH):
+        self.hash = PatchHash(algorithm)
+        self.has_patch = False
+        self.parser = PatchParser(self._patch)
 
-    return hash.hexdigest()
+    def _patch(self, data):
+        self.has_patch = True
+        self.hash.update(data)
+
+    def feed(self, line):
+        self.parser.feed(line)
+
+    # returns None if no patch was found
+    def hexdigest(self):
+        self.parser.close()
+        if not self.has_patch:
+            return None
+        return self.hash.hexdigest()
+
+    # only valid after hexdigest()
+    def hunks(self):
+        return self.hash.hunks
+
+    def files(self):
+        return self.hash.files
 
 def read_patch(f):
-    patch = ''
+    patchline = []
+    try:
+        fp = open(f, "rb")
+        parser = PatchParser(patchline.append)
+        for line in fp:
+            parser.feed(line)
+        parser.close()
+        fp.close()
+    except OSError:
+        sys.stderr.write("Unable to open patch %s\n" % f)
+        return None
+    if len(patchline) == 0:
+        return None
+    return b"".join(patchline)
+
+# returns (patch hash, hunk fingerprints) of the patch in the file f without
+# reading it all in memory. The hash is None if it doesn't contain a patch
+def fingerprint_file(f, algorithm=DEFAULT_HASH):
+    hasher = PatchHasher(algorithm)
     try:
-        f = open(f)
-        patch = f.read()
-        f.close()
-        (p, c) = parse_patch(patch)
-        return p
-    except:
+        fp = open(f, "rb")
+        for line in fp:
+            hasher.feed(line)
+        fp.close()
+    except OSError:
         sys.stderr.write("Unable to open patch %s\n" % f)
+        return (None, [])
+    return (hasher.hexdigest(), hasher.hunks())
+
+def hash_file(f):
+    return fingerprint_file(f)[0]
+
+# Fingerprints of patch files are kept in a dbm database in the cache
+# directory so unchanged patches aren't parsed again. Files are looked up by
+# path, size and modification time first and then by content, which also
+# catches new copies of a patch that was already seen.
+class FingerprintCache:
+    def __init__(self, cache, algorithm=DEFAULT_HASH):
+        self.cache = cache
+        self.algorithm = algorithm
+        self.db = None
+
+    def _open(self):
+        if self.db is None:
+            os.makedirs(self.cache, exist_ok=True)
+            self.db = dbm.open("%s/%s" % (self.cache, FINGERPRINT_CACHE), 'c')
+        return self.db
+
+    def _content_key(self, f):
+        hash = hashlib.blake2b()
+        fp = open(f, "rb")
+        while True:
+            data = fp.read(1024 * 1024)
+            if not data:
+                break
+            hash.update(data)
+        fp.close()
+        return "content:%s:%s" % (self.algorithm, hash.hexdigest())
+
+    # returns (key, stamp, content key), the content key is None if the
+    # file changed since it was last seen
+    def _lookup(self, f):
+        st = os.stat(f)
+        key = "file:%s:%s" % (self.algorithm, os.path.realpath(f))
+        stamp = "%d %d " % (st.st_size, st.st_mtime_ns)
+        if key in self.db:
+            value = self.db[key].decode()
+            if value.startswith(stamp):
+                return (key, stamp, value[len(stamp):])
+        return (key, stamp, None)
+
+    # returns the cached (patch hash, hunk fingerprints) of the file or None
+    def get(self, f):
+        try:
+            db = self._open()
+            (key, stamp, content) = self._lookup(f)
+            if content is None or content not in db:
+                content = self._content_key(f)
+                if content not in db:
+                    return None
+                db[key] = stamp + content
+            return self._decode(db[content])
+        except dbm.error:
+            return None
+
+    def put(self, f, result):
+        (patch_hash, hunks) = result
+        try:
+            db = self._open()
+            (key, stamp, content) = self._lookup(f)
+            content = self._content_key(f)
+            db[content] = json.dumps([patch_hash, [(h[0], h[1], h[2].hex()) for h in hunks]])
+            db[key] = stamp + content
+        except dbm.error:
+            pass
+
+    # same as fingerprint_file()
+    def fingerprint(self, f):
+        # pipes can only be read once and have nothing worth caching
+        try:
+            regular = stat.S_ISREG(os.stat(f).st_mode)
+        except OSError:
+            regular = False
+        if not regular:
+            return fingerprint_file(f, self.algorithm)
+        result = self.get(f)
+        if result is None:
+            result = fingerprint_file(f, self.algorithm)
+            self.put(f, result)
+        return result
+
+    def _decode(self, value):
+        (patch_hash, hunks) = json.loads(value.decode())
+        return (patch_hash, [(h[0], h[1], bytes.fromhex(h[2])) for h in hunks])
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+# yields (commit, patch hash, hunk fingerprints) for each commit in the
+# output of git log --format=%x00%H -p
+def read_fingerprints(proc, path, algorithm=DEFAULT_HASH):
+    sha = None
+    hasher = None
+    try:
+        for line in proc.stdout:
+            if line.startswith(b'\0'):
+                if sha is not None:
+                    yield (sha, hasher.hexdigest(), hasher.hunks())
+                sha = line[1:].strip().decode()
+                hasher = PatchHasher(algorithm)
+            elif hasher is not None:
+                hasher.feed(line)
+        if sha is not None:
+            yield (sha, hasher.hexdigest(), hasher.hunks())
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    if rc != 0:
+        raise Exception("Unable to read history from %s (git log returned %d)" % (path, rc))
+
+# yields (commit, patch hash, hunk fingerprints) for every non merge commit in
+# revs, reading all the diffs from a single git log. Commits without changes
+# have no hash
+def fingerprint_commits(path, revs):
+    proc = subprocess.Popen(["git", "-C", path, "log", "--no-merges", "-p", "--format=%x00%H"] + revs + ["--"], stdout=subprocess.PIPE)
+    return read_fingerprints(proc, path)
+
+def hash_commits(path, revs):
+    for (sha, patch_hash, hunks) in fingerprint_commits(path, revs):
+        yield (sha, patch_hash)
+
+# same as fingerprint_commits() but for a list of unrelated commits, in that
+# order
+def fingerprint_commit_list(path, shas, algorithm=DEFAULT_HASH):
+    proc = subprocess.Popen(["git", "-C", path, "log", "--no-walk=unsorted", "-p", "--format=%x00%H", "--stdin"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # git reads all the revisions before writing anything
+    proc.stdin.write(''.join(["%s\n" % sha for sha in shas]).encode())
+    proc.stdin.close()
+    return read_fingerprints(proc, path, algorithm)
+
+# returns (similarity in percent, hunks only in a, hunks only in b)
+def compare_hunks(a, b):
+    output = []
+    for (x, y) in [(a, b), (b, a)]:
+        remaining = collections.Counter([h[2] for h in y])
+        only = []
+        for h in x:
+            if remaining[h[2]] > 0:
+                remaining[h[2]] -= 1
+            else:
+                only.append(h)
+        output.append(only)
+    common = len(a) - len(output[0])
+    total = len(a) + len(b) - common
+    if total == 0:
+        return (100, [], [])
+    return (100 * common // total, output[0], output[1])
+
+def print_hunks(prefix, hunks):
+    for (filename, header, fingerprint) in hunks:
+        print("%s%s %s" % (prefix, filename, header))
+
+# returns (upstream repository path, branch, index cache directory)
+def get_upstream_config(config):
+    return (qconfig.get_repo_path(config, 'upstream'), qconfig.get_repo_branch(config, 'upstream'), get_cache_dir(config))
+
+def get_cache_dir(config):
+    cache = DEFAULT_CACHE_DIR
+    if 'umatch' in config and 'cache' in config['umatch']:
+        cache = config['umatch']['cache']
+    return os.path.expanduser(cache)
+
+def get_hash_algorithm(config, algorithm):
+    if algorithm is None:
+        algorithm = DEFAULT_HASH
+        if 'umatch' in config and 'hash' in config['umatch']:
+            algorithm = config['umatch']['hash']
+    if algorithm not in HASH_ALGORITHMS:
+        raise Exception("Unknown hash %s (use one of %s)" % (algorithm, ", ".join(HASH_ALGORITHMS)))
+    return algorithm
+
+def get_index_filename(cache):
+    return "%s/%s" % (cache, UPSTREAM_INDEX)
+
+# hashes every upstream commit since the last update (or since the commit
+# "since" on the first one) and adds them to the index. Returns the new tip
+def update_index(path, branch, cache, last, since):
+    os.makedirs(cache, exist_ok=True)
+    tip = subprocess.check_output(["git", "-C", path, "rev-parse", "%s^{commit}" % branch]).decode().strip()
+    revs = [tip]
+    if last:
+        revs.append("^%s" % last)
+    elif since:
+        revs.append("^%s" % since)
+
+    # tables: patch hash -> commits, hunk -> commits, commit -> hunks
+    index = qindex.PackedIndex(get_index_filename(cache))
+    tables = [index.to_dict(i) for i in range(3)]
+    # indexes from before hunk fingerprints need the old commits again
+    rehash = []
+    if index.table_count() == 1:
+        rehash = sorted(set([c.hex() for v in tables[0].values() for c in v]))
+    index.close()
+
+    def add(sha, patch_hash, hunks):
+        if patch_hash is None:
+            return
+        c = bytes.fromhex(sha)
+        found = tables[0].setdefault(bytes.fromhex(patch_hash), [])
+        if c not in found:
+            found.append(c)
+        if len(hunks) == 0 or c in tables[2]:
+            return
+        tables[2][c] = [h[2] for h in hunks]
+        for h in set(tables[2][c]):
+            tables[1].setdefault(h, []).append(c)
+
+    if len(rehash) > 0:
+        sys.stderr.write("Adding hunk fingerprints for %d indexed commits\n" % len(rehash))
+        for (sha, patch_hash, hunks) in fingerprint_commit_list(path, rehash):
+            add(sha, patch_hash, hunks)
+    for (sha, patch_hash, hunks) in fingerprint_commits(path, revs):
+        add(sha, patch_hash, hunks)
+    qindex.write_index(get_index_filename(cache), *tables)
+    return tip
+
+# returns the upstream commits with the same changes as a patch, given its
+# hash
+def find_patch(cache, patch_hash):
+    if patch_hash is None:
+        return []
+    index = qindex.PackedIndex(get_index_filename(cache))
+    return [c.hex() for c in index.lookup(bytes.fromhex(patch_hash))]
+
+# returns up to limit (commit, similarity, hunks missing upstream) for the
+# upstream commits sharing hunks with a patch, best first
+def find_similar(cache, hunks, limit=5):
+    index = qindex.PackedIndex(get_index_filename(cache))
+    candidates = collections.Counter()
+    for h in set([h[2] for h in hunks]):
+        for c in index.lookup(h, 1):
+            candidates[c] += 1
+
+    output = []
+    for (c, n) in candidates.most_common(limit * 4):
+        upstream = [(None, None, h) for h in index.lookup(c, 2)]
+        (score, only_patch, only_upstream) = compare_hunks(hunks, upstream)
+        output.append((c.hex(), score, only_patch))
+    index.close()
+    output.sort(key=lambda x: x[1], reverse=True)
+    return output[:limit]
+
+# returns the upstream commit a patch was taken from, or None
+def get_patch_commit(f):
+    try:
+        fp = open(f, "rb")
+    except OSError:
+        return None
+    commit = None
+    for line in fp:
+        # the reference is always in the description
+        if line.startswith(b'diff '):
+            break
+        res = _commit_re.match(line)
+        if res is None:
+            res = _cherry_pick_re.match(line)
+        if res:
+            commit = res.group(1).decode()
+            break
+        if _rhel_only_re.match(line):
+            break
+    fp.close()
+    return commit
+
+# compares every patch in the series with the upstream commit it references.
+# The patches are hashed by a pool of processes while the upstream diffs are
+# read from a single git log
+def check_series(path, fingerprints, jobs, verbose=False):
+    series = read_series()
+    commits = [get_patch_commit("patches/%s" % p) for p in series]
+    patches = [fingerprints.get("patches/%s" % p) for p in series]
+    missing = [i for i in range(len(series)) if patches[i] is None]
+
+    resolver = gitbatch.CatFileCheck(path)
+    known = set()
+    for c in commits:
+        if c is not None and c not in known and resolver.resolve_commit(c) == c:
+            known.add(c)
+    resolver.close()
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunksize = max(1, len(missing) // (jobs * 4))
+        hashed = pool.map_async(functools.partial(fingerprint_file, algorithm=fingerprints.algorithm),
+                                ["patches/%s" % series[i] for i in missing], chunksize)
+        upstream = dict()
+        if len(known) > 0:
+            for (sha, patch_hash, hunks) in fingerprint_commit_list(path, [c for c in commits if c in known], fingerprints.algorithm):
+                upstream[sha] = (patch_hash, hunks)
+        hashed = hashed.get()
+    finally:
+        pool.close()
+        pool.join()
+    for (i, result) in zip(missing, hashed):
+        patches[i] = result
+        fingerprints.put("patches/%s" % series[i], result)
+
+    ret = 0
+    counts = collections.Counter()
+    for (name, commit, (patch_hash, hunks)) in zip(series, commits, patches):
+        score = ""
+        differ = ([], [])
+        if commit is None:
+            status = "no-commit"
+        elif commit not in known:
+            status = "unknown"
+        elif patch_hash is None or upstream[commit][0] is None:
+            status = "no-patch"
+        elif patch_hash == upstream[commit][0]:
+            status = "match"
+        else:
+            status = "mismatch"
+            (similarity, only_patch, only_upstream) = compare_hunks(hunks, upstream[commit][1])
+            score = " (%d%%)" % similarity
+            differ = (only_patch, only_upstream)
+        if status != "match":
+            ret = 1
+        counts[status] += 1
+        if commit is None:
+            commit = '-'
+        print("%-9s %-12s %s%s" % (status, commit[:12], name, score))
+        if verbose:
+            print_hunks("    - ", differ[0])
+            print_hunks("    + ", differ[1])
+
+    sys.stderr.write("%d patches: %s\n" % (len(series), ", ".join(["%d %s" % (counts[s], s) for s in sorted(counts)])))
+    return ret
 
 def main(argv):
-    if len(argv) < 3:
-        sys.stderr.write("%s <patch 1> <patch 2>\n" % argv[0])
+    usage = "usage: %prog [options] <patch 1> <patch 2>\n       %prog --series [-j JOBS]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-u", "--update", dest="do_update", default=False, help="Update the index of upstream patch hashes", action="store_true")
+    parser.add_option("-s", "--since", dest="since", default=None, help="When creating the index, only hash upstream commits after COMMIT", metavar="COMMIT")
+    parser.add_option("-f", "--find", dest="find", default=None, help="Look up which upstream commits have the same changes as PATCH", metavar="PATCH")
+    parser.add_option("-S", "--series", dest="do_series", default=False, help="Compare every patch in the quilt series with its upstream commit", action="store_true")
+    parser.add_option("-p", "--partial", dest="partial", default=False, help="With --find, also list upstream commits sharing hunks with PATCH", action="store_true")
+    parser.add_option("-v", "--verbose", dest="verbose", default=False, help="Show the similarity and the hunks that differ", action="store_true")
+    parser.add_option("-H", "--hash", dest="algorithm", default=None, help="Compare patches using ALGORITHM (sha512 or blake2b), the index always uses sha512", metavar="ALGORITHM")
+    parser.add_option("-j", "--jobs", dest="jobs", default=os.cpu_count() or 1, type="int", help="With --series, hash the patches using JOBS processes", metavar="JOBS")
+    (options, args) = parser.parse_args(argv[1:])
+
+    config = qconfig.load_config()
+    algorithm = get_hash_algorithm(config, options.algorithm)
+
+    if options.do_update or options.find is not None or options.do_series:
+        (path, branch, cache) = get_upstream_config(config)
+
+        if options.do_update:
+            if 'umatch' not in config:
+                config['umatch'] = {}
+            last = None
+            if 'last' in config['umatch']:
+                last = config['umatch']['last']
+            config['umatch']['last'] = update_index(path, branch, cache, last, options.since)
+            qconfig.write_config(config)
+            return 0
+
+        if options.do_series:
+            fingerprints = FingerprintCache(cache, algorithm)
+            ret = check_series(path, fingerprints, options.jobs, options.verbose)
+            fingerprints.close()
+            return ret
+
+        fingerprints = FingerprintCache(cache, DEFAULT_HASH)
+        (patch_hash, hunks) = fingerprints.fingerprint(options.find)
+        fingerprints.close()
+        found = find_patch(cache, patch_hash)
+        for c in found:
+            print(c)
+        if options.partial:
+            for (c, similarity, only_patch) in find_similar(cache, hunks):
+                if c in found:
+                    continue
+                print("%s %d%%" % (c, similarity))
+                if options.verbose:
+                    print_hunks("    - ", only_patch)
+        if len(found) == 0:
+            return 1
+        return 0
+
+    if len(args) < 2:
+        parser.print_usage(sys.stderr)
         return 1
 
-    patch1 = read_patch(argv[1])
-    patch2 = read_patch(argv[2])
-    if hash_patch(patch1) != hash_patch(patch2):
+    fingerprints = FingerprintCache(get_cache_dir(config), algorithm)
+    (hash1, hunks1) = fingerprints.fingerprint(args[0])
+    (hash2, hunks2) = fingerprints.fingerprint(args[1])
+    fingerprints.close()
+    if options.verbose:
+        (similarity, only1, only2) = compare_hunks(hunks1, hunks2)
+        print("%d%% similar" % similarity)
+        print_hunks("- ", only1)
+        print_hunks("+ ", only2)
+    if hash1 != hash2:
         return 1
 
     return 0